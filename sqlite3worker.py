@@ -24,44 +24,207 @@ __author__ = "Shawn Lee"
 __email__ = "shawnl@palantir.com"
 __license__ = "MIT"
 
+import collections
+import itertools
 import logging
+import multiprocessing
+from multiprocessing.connection import Client, Listener
 import platform
 import os
+import pickle
+import re
 import sqlite3
+import sys
 import threading
 import time
 try:
 	import queue as Queue # module re-named in Python 3
 except ImportError: # pragma: no cover
 	import Queue
+try:
+	from concurrent.futures import Future
+except ImportError: # pragma: no cover ( Python 2 without the futures backport )
+	Future = None
+try:
+	import asyncio
+except ImportError: # pragma: no cover ( Python 2 )
+	asyncio = None
 
 LOGGER = logging.getLogger('sqlite3worker')
+SLOW_LOGGER = logging.getLogger('sqlite3worker.slow')
 
 OperationalError = sqlite3.OperationalError
 ProgrammingError = sqlite3.ProgrammingError
 
+class _DescriptionCache ( object ):
+	"""Memoize something built from the column names of a cursor.description.
+	A result set hands the same description object to the row factory for
+	every row, so the common case is a single identity check. Different
+	descriptions with the same column names share one cache entry.
+	"""
+	__slots__ = ( '_build', '_last', '_cache' )
+	_max_entries = 256
+	
+	def __init__ ( self, build ):
+		self._build = build
+		self._last = ( None, None )
+		self._cache = {}
+	
+	def lookup ( self, description ):
+		last = self._last # read once, another thread may replace it
+		if last[0] is description:
+			return last[1]
+		names = tuple ( col[0] for col in description )
+		value = self._cache.get ( names )
+		if value is None:
+			if len ( self._cache ) >= self._max_entries:
+				self._cache.clear()
+			value = self._cache[names] = self._build ( names )
+		self._last = ( description, value )
+		return value
+
+def _dict_builder ( names ):
+	# a dict display compiled for this set of columns beats building the dict up in a loop
+	return eval ( 'lambda row: {{{}}}'.format ( ', '.join (
+		'{!r}: row[{}]'.format ( name, idx ) for idx, name in enumerate ( names ) ) ) )
+
+_dict_builders = _DescriptionCache ( _dict_builder )
+
 def dict_factory ( cursor, row ):
-	d = {}
-	for idx, col in enumerate ( cursor.description ):
-		d[col[0]] = row[idx]
-	return d
+	return _dict_builders.lookup ( cursor.description ) ( row )
+
+def _namedtuple_class ( names ):
+	return collections.namedtuple ( 'Row', names, rename=True )
+
+_namedtuple_classes = _DescriptionCache ( _namedtuple_class )
+
+def namedtuple_factory ( cursor, row ):
+	"""Row factory returning a namedtuple, the class is built once per set of column names."""
+	return _namedtuple_classes.lookup ( cursor.description )._make ( row )
+
+class _RowColumns ( object ):
+	__slots__ = ( 'keys', 'index' )
+	
+	def __init__ ( self, names ):
+		self.keys = list ( names )
+		self.index = {}
+		for idx, name in enumerate ( names ):
+			self.index.setdefault ( name.lower(), idx ) # first column wins, like sqlite3.Row
+
+_row_columns = _DescriptionCache ( _RowColumns )
+
+class Row ( object ):
+	"""sqlite3.Row work-alike.
+	Native sqlite3.Row only accepts a real sqlite3.Cursor, this one also works
+	with Sqlite3worker_dbapi_cursor. Rows can be indexed by position or by
+	case-insensitive column name. The name lookup table is shared by every row
+	of a result set.
+	"""
+	__slots__ = ( '_columns', '_values' )
+	
+	def __init__ ( self, cursor, row ):
+		self._columns = _row_columns.lookup ( cursor.description )
+		self._values = row
+	
+	def keys ( self ):
+		return list ( self._columns.keys )
+	
+	def __getitem__ ( self, key ):
+		if isinstance ( key, ( int, slice ) ):
+			return self._values[key]
+		try:
+			return self._values[self._columns.index[key.lower()]]
+		except ( KeyError, AttributeError ):
+			raise IndexError ( 'No item with that key' )
+	
+	def __len__ ( self ):
+		return len ( self._values )
+	
+	def __iter__ ( self ):
+		return iter ( self._values )
+	
+	def __eq__ ( self, other ):
+		if not isinstance ( other, Row ):
+			return NotImplemented
+		return self._columns.keys == other._columns.keys and tuple ( self._values ) == tuple ( other._values )
+	
+	def __ne__ ( self, other ):
+		eq = self.__eq__ ( other )
+		return eq if eq is NotImplemented else not eq
+	
+	def __hash__ ( self ):
+		return hash ( tuple ( self._columns.keys ) ) ^ hash ( tuple ( self._values ) )
+	
+	def __repr__ ( self ):
+		return '<{} {!r}>'.format ( type ( self ).__name__, tuple ( self._values ) )
 
-# native sqlite3.Row doesn't like our proxy cursor class so we're going to substitute dict_factory instead which is almost the same thing
-Row = dict_factory # sqlite3.Row
+class Sqlite3WorkerResult ( tuple ):
+	"""The ( rows, description, lastrowid ) tuple returned by execute_ex(), also carrying the cursor's rowcount."""
+	rowcount = -1
+	
+	def __new__ ( cls, rows, description, lastrowid, rowcount=-1 ):
+		self = tuple.__new__ ( cls, ( rows, description, lastrowid ) )
+		self.rowcount = rowcount
+		return self
+	
+	def __reduce__ ( self ):
+		return ( Sqlite3WorkerResult, tuple ( self ) + ( self.rowcount, ) )
 
 class Frozen_object ( object ):
 	def __setattr__ ( self, key, value ):
-		if key not in dir ( self ): # prevent from accidentally creating new attributes
+		if not hasattr ( type ( self ), key ): # prevent from accidentally creating new attributes
 			raise AttributeError ( '{!r} object has no attribute {!r}'.format ( type ( self ).__name__, key ) )
 		super ( Frozen_object, self ).__setattr__ ( key, value )
 
-class Sqlite3WorkerRequest ( Frozen_object ):
+class Sqlite3WorkerReply ( object ):
+	"""One-shot reply slot handed from the worker thread back to a blocked caller.
+	Much cheaper to build than a Queue.Queue: a single pre-acquired lock that
+	put() releases and get() waits on. Exactly one put() and one get() per slot.
+	"""
+	__slots__ = ( '_lock', '_value' )
+	
+	def __init__ ( self ):
+		self._lock = threading.Lock()
+		self._lock.acquire()
+		self._value = None
+	
+	def put ( self, value ):
+		self._value = value
+		self._lock.release()
+	
+	def get ( self ):
+		self._lock.acquire()
+		return self._value
+
+class Sqlite3WorkerRequest ( object ):
+	"""Base class of everything that goes through a worker queue.
+	Requests use __slots__, which keeps them small and quick to build and
+	still prevents accidentally creating new attributes.
+	"""
+	__slots__ = ()
+	
 	def execute ( self ): # pragma: no cover
 		raise NotImplementedError ( type ( self ).__name__ + '.execute()' )
+	
+	def _init_reply ( self, future ):
+		"""Replies go to future if the caller asked for one, otherwise to a reply slot the caller blocks on."""
+		self.results = Sqlite3WorkerReply() if future is None else None
+		self.future = future
+	
+	def _cancelled ( self ):
+		return self.future is not None and not self.future.set_running_or_notify_cancel()
+	
+	def _reply ( self, success, result ):
+		if self.future is None:
+			self.results.put ( ( success, result ) )
+		elif success:
+			self.future.set_result ( result )
+		else:
+			self.future.set_exception ( result )
+		return result
 
 class Sqlite3WorkerSetRowFactory ( Sqlite3WorkerRequest ):
-	thread = None
-	row_factory = None
+	__slots__ = ( 'thread', 'row_factory' )
 	
 	def __init__ ( self, thread, row_factory ):
 		self.thread = thread
@@ -71,8 +234,7 @@ class Sqlite3WorkerSetRowFactory ( Sqlite3WorkerRequest ):
 		self.thread._sqlite3_cursor.row_factory = self.row_factory
 
 class Sqlite3WorkerSetTextFactory ( Sqlite3WorkerRequest ):
-	thread = None
-	text_factory = None
+	__slots__ = ( 'thread', 'text_factory' )
 	
 	def __init__ ( self, thread, text_factory ):
 		self.thread = thread
@@ -82,72 +244,783 @@ class Sqlite3WorkerSetTextFactory ( Sqlite3WorkerRequest ):
 		self.thread._sqlite3_conn.text_factory = self.text_factory
 
 class Sqlite3WorkerExecute ( Sqlite3WorkerRequest ):
-	thread = None
-	query = None
-	values = None
-	results = None
+	__slots__ = ( 'thread', 'query', 'values', 'results', 'future' )
 	
-	def __init__ ( self, thread, query, values ):
+	def __init__ ( self, thread, query, values, future=None ):
 		self.thread = thread
 		self.query = query
 		self.values = values
-		self.results = Queue.Queue()
+		self._init_reply ( future )
 	
 	def execute ( self ):
+		if self._cancelled():
+			return
 		LOGGER.debug ( "run execute: %s", self.query )
 		cur = self.thread._sqlite3_cursor
 		try:
 			cur.execute ( self.query, self.values )
-			result = ( cur.fetchall(), cur.description, cur.lastrowid )
+			if self.thread._profiler is not None:
+				self.thread._fetch_started = time.time()
+			result = Sqlite3WorkerResult ( cur.fetchall(), cur.description, cur.lastrowid, cur.rowcount )
 			success = True
 		except Exception as err:
 			LOGGER.debug (
 				"Sqlite3WorkerExecute.execute sending exception back to calling thread: {!r}".format ( err ) )
 			result = err
 			success = False
-		self.results.put ( ( success, result ) )
+		return self._reply ( success, result )
+
+class Sqlite3WorkerExecuteMany ( Sqlite3WorkerRequest ):
+	__slots__ = ( 'thread', 'query', 'seq_of_values', 'results', 'future' )
+	
+	def __init__ ( self, thread, query, seq_of_values, future=None ):
+		self.thread = thread
+		self.query = query
+		self.seq_of_values = seq_of_values
+		self._init_reply ( future )
+	
+	def execute ( self ):
+		if self._cancelled():
+			return
+		LOGGER.debug ( "run executemany: %s", self.query )
+		cur = self.thread._sqlite3_cursor
+		try:
+			# seq_of_values may be a generator, it is consumed here on the worker thread
+			# so the caller never has to materialize the whole data set
+			cur.executemany ( self.query, self.seq_of_values )
+			result = Sqlite3WorkerResult ( cur.fetchall(), cur.description, cur.lastrowid, cur.rowcount )
+			success = True
+		except Exception as err:
+			LOGGER.debug (
+				"Sqlite3WorkerExecuteMany.execute sending exception back to calling thread: {!r}".format ( err ) )
+			result = err
+			success = False
+		return self._reply ( success, result )
 
 class Sqlite3WorkerExecuteScript ( Sqlite3WorkerRequest ):
-	thread = None
-	query = None
-	results = None
+	__slots__ = ( 'thread', 'query', 'results', 'future' )
 	
-	def __init__ ( self, thread, query ):
+	def __init__ ( self, thread, query, future=None ):
 		self.thread = thread
 		self.query = query
-		self.results = Queue.Queue()
+		self._init_reply ( future )
 	
 	def execute ( self ):
+		if self._cancelled():
+			return
 		LOGGER.debug ( "run executescript: %s", self.query )
 		cur = self.thread._sqlite3_cursor
 		try:
 			cur.executescript ( self.query )
-			result = ( cur.fetchall(), cur.description, cur.lastrowid )
+			result = Sqlite3WorkerResult ( cur.fetchall(), cur.description, cur.lastrowid, cur.rowcount )
 			success = True
 		except Exception as err:
 			LOGGER.debug (
 				"Sqlite3WorkerExecuteScript.execute sending exception back to calling thread: {!r}".format ( err ) )
 			result = err
 			success = False
-		self.results.put ( ( success, result ) )
+		return self._reply ( success, result )
+
+class Sqlite3WorkerStreamOpen ( Sqlite3WorkerRequest ):
+	__slots__ = ( 'thread', 'query', 'values', 'chunk_size', 'results', 'future' )
+	
+	def __init__ ( self, thread, query, values, chunk_size ):
+		self.thread = thread
+		self.query = query
+		self.values = values
+		self.chunk_size = chunk_size
+		self._init_reply ( None )
+	
+	def execute ( self ):
+		LOGGER.debug ( "run stream open: %s", self.query )
+		# streams get their own cursor so they can stay open while other requests use the shared one
+		cur = self.thread._sqlite3_conn.cursor()
+		cur.row_factory = self.thread._sqlite3_cursor.row_factory
+		try:
+			cur.execute ( self.query, self.values )
+			rows = cur.fetchmany ( self.chunk_size )
+			result = ( rows, cur.description, cur.lastrowid, cur if len ( rows ) == self.chunk_size else None )
+			success = True
+		except Exception as err:
+			LOGGER.debug (
+				"Sqlite3WorkerStreamOpen.execute sending exception back to calling thread: {!r}".format ( err ) )
+			result = err
+			success = False
+		if not success or result[3] is None:
+			cur.close()
+		return self._reply ( success, result )
+
+class Sqlite3WorkerStreamFetch ( Sqlite3WorkerRequest ):
+	__slots__ = ( 'thread', 'cursor', 'chunk_size', 'results', 'future' )
+	
+	def __init__ ( self, thread, cursor, chunk_size ):
+		self.thread = thread
+		self.cursor = cursor
+		self.chunk_size = chunk_size
+		self._init_reply ( None )
+	
+	def execute ( self ):
+		try:
+			rows = self.cursor.fetchmany ( self.chunk_size )
+			if len ( rows ) < self.chunk_size:
+				self.cursor.close()
+			return self._reply ( True, rows )
+		except Exception as err:
+			LOGGER.debug (
+				"Sqlite3WorkerStreamFetch.execute sending exception back to calling thread: {!r}".format ( err ) )
+			self.cursor.close()
+			return self._reply ( False, err )
+
+class Sqlite3WorkerStreamClose ( Sqlite3WorkerRequest ):
+	__slots__ = ( 'thread', 'cursor' )
+	
+	def __init__ ( self, thread, cursor ):
+		self.thread = thread
+		self.cursor = cursor
+	
+	def execute ( self ):
+		LOGGER.debug ( "run stream close" )
+		self.cursor.close()
 
 class Sqlite3WorkerCommit ( Sqlite3WorkerRequest ):
-	thread = None
+	__slots__ = ( 'thread', 'future' )
 	
-	def __init__ ( self, thread ):
+	def __init__ ( self, thread, future=None ):
 		self.thread = thread
+		self.future = future # plain commits are fire and forget, no reply queue needed
 	
 	def execute ( self ):
+		if self._cancelled():
+			return
 		LOGGER.debug("run commit")
-		self.thread._sqlite3_conn.commit()
+		if self.future is None:
+			self.thread._commit()
+			return
+		try:
+			self.thread._commit()
+			return self._reply ( True, None )
+		except Exception as err:
+			return self._reply ( False, err )
+
+_SAVEPOINT = 'sqlite3worker_transaction'
+
+def _release_savepoint ( thread, commit ):
+	"""End the transaction savepoint, on success committing the connection."""
+	conn = thread._sqlite3_conn
+	if commit:
+		try:
+			conn.execute ( 'RELEASE ' + _SAVEPOINT )
+		except Exception:
+			_release_savepoint ( thread, False )
+			raise
+		thread._commit()
+	else:
+		# only undo the work done since the savepoint, other callers' uncommitted work survives
+		conn.execute ( 'ROLLBACK TO ' + _SAVEPOINT )
+		conn.execute ( 'RELEASE ' + _SAVEPOINT )
+
+class Sqlite3WorkerTransactionEnd ( Sqlite3WorkerRequest ):
+	__slots__ = ( 'thread', 'commit', 'results', 'future' )
+	
+	def __init__ ( self, thread, commit ):
+		self.thread = thread
+		self.commit = commit
+		self._init_reply ( None )
+	
+	def execute ( self ):
+		LOGGER.debug ( "run transaction end: %s", 'commit' if self.commit else 'rollback' )
+		try:
+			_release_savepoint ( self.thread, self.commit )
+			return self._reply ( True, None )
+		except Exception as err:
+			return self._reply ( False, err )
+
+class Sqlite3WorkerTransaction ( Sqlite3WorkerRequest ):
+	"""Holds the worker thread for the length of a Sqlite3Worker.transaction() block.
+	Once the savepoint is open it replies, then serves only the requests sent
+	to its private queue until a Sqlite3WorkerTransactionEnd arrives, so
+	nothing from other threads can interleave with the transaction.
+	"""
+	__slots__ = ( 'thread', 'requests', 'results', 'future' )
+	
+	def __init__ ( self, thread ):
+		self.thread = thread
+		self.requests = Sqlite3WorkerQueue()
+		self._init_reply ( None )
+	
+	def execute ( self ):
+		LOGGER.debug ( "run transaction" )
+		thread = self.thread
+		try:
+			thread._sqlite3_conn.execute ( 'SAVEPOINT ' + _SAVEPOINT )
+		except Exception as err:
+			return self._reply ( False, err )
+		self._reply ( True, None )
+		while True:
+			queued_at, x = self.requests.get_timed()
+			if thread._metrics is None and thread._profiler is None:
+				x.execute()
+			else:
+				_run_instrumented ( thread, x, queued_at, thread._metrics, thread._profiler )
+			if isinstance ( x, Sqlite3WorkerTransactionEnd ):
+				return
+
+class Sqlite3WorkerRunInTransaction ( Sqlite3WorkerRequest ):
+	__slots__ = ( 'thread', 'fn', 'args', 'kwargs', 'results', 'future' )
+	
+	def __init__ ( self, thread, fn, args, kwargs, future=None ):
+		self.thread = thread
+		self.fn = fn
+		self.args = args
+		self.kwargs = kwargs
+		self._init_reply ( future )
+	
+	def execute ( self ):
+		if self._cancelled():
+			return
+		LOGGER.debug ( "run in transaction: %r", self.fn )
+		thread = self.thread
+		try:
+			thread._sqlite3_conn.execute ( 'SAVEPOINT ' + _SAVEPOINT )
+		except Exception as err:
+			return self._reply ( False, err )
+		try:
+			result = self.fn ( thread._sqlite3_conn, *self.args, **self.kwargs )
+		except Exception as err:
+			LOGGER.debug (
+				"Sqlite3WorkerRunInTransaction.execute rolling back and sending exception back to calling thread: {!r}".format ( err ) )
+			try:
+				_release_savepoint ( thread, False )
+			except Exception as rollback_err: # pragma: no cover ( only if the connection itself is broken )
+				LOGGER.error ( 'rollback failed: {!r}'.format ( rollback_err ) )
+			return self._reply ( False, err )
+		try:
+			_release_savepoint ( thread, True )
+		except Exception as err:
+			return self._reply ( False, err )
+		return self._reply ( True, result )
+
+class Sqlite3WorkerCall ( Sqlite3WorkerRequest ):
+	__slots__ = ( 'thread', 'fn', 'args', 'kwargs', 'results', 'future' )
+	
+	def __init__ ( self, thread, fn, args, kwargs, future=None ):
+		self.thread = thread
+		self.fn = fn
+		self.args = args
+		self.kwargs = kwargs
+		self._init_reply ( future )
+	
+	@property
+	def query ( self ):
+		# what metrics and the slow query log report this request as
+		return '<call {}>'.format ( getattr ( self.fn, '__name__', type ( self.fn ).__name__ ) )
+	
+	def execute ( self ):
+		if self._cancelled():
+			return
+		LOGGER.debug ( "run call: %r", self.fn )
+		try:
+			result = self.fn ( self.thread._sqlite3_conn, *self.args, **self.kwargs )
+			success = True
+		except Exception as err:
+			LOGGER.debug (
+				"Sqlite3WorkerCall.execute sending exception back to calling thread: {!r}".format ( err ) )
+			result = err
+			success = False
+		return self._reply ( success, result )
+
+class Sqlite3WorkerAttach ( Sqlite3WorkerRequest ):
+	__slots__ = ( 'thread', 'alias', 'file_name', 'results', 'future' )
+	
+	def __init__ ( self, thread, alias, file_name ):
+		self.thread = thread
+		self.alias = alias
+		self.file_name = file_name # None to detach
+		self._init_reply ( None )
+	
+	def execute ( self ):
+		LOGGER.debug ( "run attach: %s %s", self.alias, self.file_name )
+		thread = self.thread
+		try:
+			thread._commit() # sqlite can't attach or detach inside a transaction
+			_attach ( thread._sqlite3_conn, self.alias, self.file_name )
+		except Exception as err:
+			return self._reply ( False, err )
+		attached = tuple ( a for a in thread._attached if a[0] != self.alias )
+		if self.file_name is not None:
+			attached += ( ( self.alias, self.file_name ), )
+		thread._attached = attached # readers pick up the new tuple before their next request
+		return self._reply ( True, None )
+
+# the requests whose query goes through sqlite3's statement cache
+_CACHED_REQUESTS = ( Sqlite3WorkerExecute, Sqlite3WorkerExecuteMany, Sqlite3WorkerStreamOpen )
 
 class Sqlite3WorkerExit ( Exception, Sqlite3WorkerRequest ):
 	def execute ( self ):
 		raise self
 
+_sql_literals = re.compile ( r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b" )
+
+def normalize_sql ( query ):
+	"""Collapse whitespace and replace literals with ? so statements that differ only in constants aggregate together."""
+	return ' '.join ( _sql_literals.sub ( '?', query ).split() )
+
+def _is_busy ( err ):
+	return isinstance ( err, OperationalError ) and ( 'locked' in str ( err ) or 'busy' in str ( err ) )
+
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BULK = 'bulk'
+_PRIORITIES = ( PRIORITY_INTERACTIVE, PRIORITY_BULK )
+
+BACKPRESSURE_BLOCK = 'block'
+BACKPRESSURE_FAIL = 'fail'
+BACKPRESSURE_TIMEOUT = 'timeout'
+BACKPRESSURE_SHED = 'shed'
+_BACKPRESSURES = ( BACKPRESSURE_BLOCK, BACKPRESSURE_FAIL, BACKPRESSURE_TIMEOUT, BACKPRESSURE_SHED )
+
+class Sqlite3WorkerQueue ( Queue.Queue ):
+	"""Queue.Queue that remembers when each item was queued and how deep it has ever been.
+	Worker threads take items with get_timed() to learn how long they waited.
+	Items go in one of two lanes. The interactive lane (self.queue, where a
+	plain put() goes) is always served first, so a quick lookup doesn't wait
+	behind a backlog of batch work queued in the bulk lane. So the bulk lane
+	isn't starved, one bulk item is served after every bulk_every interactive
+	ones while both lanes have work. Each lane is FIFO and holds up to maxsize
+	items on its own, a full bulk lane never blocks interactive callers.
+	With target_wait (seconds) set, maxsize follows the measured service
+	rate so a full lane holds about target_wait worth of work, never more
+	than the maxsize it was created with.
+	"""
+	high_water = 0
+	bulk_every = 8
+	bulk = None
+	bulk_not_full = None
+	target_wait = None
+	maxsize_limit = 0
+	_interactive_run = 0
+	_watermarks = ()
+	_last_get = None
+	_served = 0
+	_busy = 0.0
+	
+	def __init__ ( self, maxsize=0, bulk_every=8, target_wait=None ):
+		Queue.Queue.__init__ ( self, maxsize )
+		self.bulk = collections.deque()
+		self.bulk_not_full = threading.Condition ( self.mutex )
+		self.bulk_every = bulk_every
+		self.target_wait = target_wait
+		self.maxsize_limit = maxsize
+	
+	def add_watermark ( self, callback, high, low ):
+		"""Call callback ( 'high', depth ) when the depth reaches high, then ( 'low', depth ) once it is back down to low."""
+		with self.mutex:
+			self._watermarks += ( [callback, high, low, False], )
+	
+	def remove_watermark ( self, callback ):
+		with self.mutex:
+			self._watermarks = tuple ( w for w in self._watermarks if w[0] != callback )
+	
+	def _crossed ( self, depth ):
+		"""Watermarks crossed at depth, as ( callback, event ) pairs. Needs the mutex, call them after letting go of it."""
+		fired = []
+		for w in self._watermarks:
+			if not w[3] and depth >= w[1]:
+				w[3] = True
+				fired.append ( ( w[0], 'high' ) )
+			elif w[3] and depth <= w[2]:
+				w[3] = False
+				fired.append ( ( w[0], 'low' ) )
+		return fired
+	
+	@staticmethod
+	def _fire ( fired, depth ):
+		for callback, event in fired:
+			try:
+				callback ( event, depth )
+			except Exception:
+				LOGGER.exception ( 'queue depth callback failed' )
+	
+	def _adapt ( self, waited ):
+		"""Resize the queue from the time between gets that didn't have to wait, i.e. the service time."""
+		now = time.time()
+		if not waited and self._last_get is not None:
+			self._busy += now - self._last_get
+			self._served += 1
+			if self._served >= 32:
+				if self._busy > 0:
+					size = max ( 1, min ( self.maxsize_limit, int ( self._served / self._busy * self.target_wait ) ) )
+				else: # pragma: no cover ( timer resolution )
+					size = self.maxsize_limit
+				if size > self.maxsize:
+					self.not_full.notify_all()
+					self.bulk_not_full.notify_all()
+				self.maxsize = size
+				self._served = 0
+				self._busy = 0.0
+		self._last_get = now
+	
+	def _qsize ( self ):
+		return len ( self.queue ) + len ( self.bulk )
+	
+	def put ( self, item, block=True, timeout=None, priority=PRIORITY_INTERACTIVE ):
+		"""Queue.put() that takes the lane to queue item in."""
+		if priority == PRIORITY_INTERACTIVE:
+			lane, not_full = self.queue, self.not_full
+		else:
+			lane, not_full = self.bulk, self.bulk_not_full
+		with not_full:
+			if self.maxsize > 0:
+				if not block:
+					if len ( lane ) >= self.maxsize:
+						raise Queue.Full
+				elif timeout is None:
+					while len ( lane ) >= self.maxsize:
+						not_full.wait()
+				else:
+					endtime = time.time() + timeout
+					while len ( lane ) >= self.maxsize:
+						remaining = endtime - time.time()
+						if remaining <= 0.0:
+							raise Queue.Full
+						not_full.wait ( remaining )
+			lane.append ( ( time.time(), item ) )
+			depth = len ( self.queue ) + len ( self.bulk )
+			if depth > self.high_water:
+				self.high_water = depth
+			self.unfinished_tasks += 1
+			self.not_empty.notify()
+			fired = self._crossed ( depth ) if self._watermarks else None
+		if fired:
+			self._fire ( fired, depth )
+	
+	def _get_timed ( self ):
+		if self.bulk:
+			if not self.queue or self._interactive_run >= self.bulk_every:
+				self._interactive_run = 0
+				self.bulk_not_full.notify()
+				return self.bulk.popleft()
+			self._interactive_run += 1
+		else:
+			self._interactive_run = 0
+		return self.queue.popleft()
+	
+	def _get ( self ):
+		return self._get_timed()[1]
+	
+	def get_timed ( self ):
+		"""Blocking get() returning ( time queued, item )."""
+		with self.not_empty:
+			waited = not self._qsize()
+			while not self._qsize():
+				self.not_empty.wait()
+			queued_at_item = self._get_timed()
+			self.not_full.notify()
+			if self.target_wait is not None:
+				self._adapt ( waited )
+			depth = self._qsize()
+			fired = self._crossed ( depth ) if self._watermarks else None
+		if fired:
+			self._fire ( fired, depth )
+		return queued_at_item
+
+class Sqlite3WorkerMetrics ( object ):
+	"""Counters and timings collected by the worker thread, see Sqlite3Worker.stats().
+	Only exists when metrics are turned on, the worker loop skips all of this
+	when Sqlite3WorkerThread._metrics is None. Hooks are called on the worker
+	thread as hook ( event, info ) with event 'request' or 'commit', they
+	should be quick.
+	sqlite3 doesn't report on its statement cache, so statement cache hits
+	and misses come from an LRU of cached_statements query strings per
+	connection, mirroring the one sqlite3 keeps.
+	"""
+	_max_statements = 1000
+	
+	def __init__ ( self, cached_statements=128 ):
+		self._lock = threading.Lock()
+		self._hooks = []
+		self._normalized = {}
+		self._cached_statements = cached_statements
+		self._statement_caches = {}
+		self.reset()
+	
+	def reset ( self ):
+		with self._lock:
+			self._started = time.time()
+			self._requests = 0
+			self._errors = 0
+			self._busy = 0
+			self._rows = 0
+			self._wait_total = 0.0
+			self._wait_max = 0.0
+			self._exec_total = 0.0
+			self._exec_max = 0.0
+			self._commits = 0
+			self._commit_total = 0.0
+			self._commit_max = 0.0
+			self._cache_hits = 0
+			self._cache_misses = 0
+			self._statements = {}
+	
+	def add_hook ( self, hook ):
+		self._hooks = self._hooks + [hook] # copy on write, the worker iterates without locking
+	
+	def remove_hook ( self, hook ):
+		hooks = list ( self._hooks )
+		hooks.remove ( hook )
+		self._hooks = hooks
+	
+	def _statement_key ( self, x ):
+		query = getattr ( x, 'query', None )
+		if query is None:
+			return '<{}>'.format ( type ( x ).__name__ )
+		if isinstance ( x, Sqlite3WorkerCall ):
+			return query
+		key = self._normalized.get ( query )
+		if key is None:
+			if len ( self._normalized ) >= self._max_statements:
+				self._normalized.clear()
+			key = self._normalized[query] = normalize_sql ( query )
+		return key
+	
+	def _statement_cached ( self, x ):
+		"""True if sqlite3 would have found x's query in its statement cache, None if x doesn't go through the cache."""
+		if not isinstance ( x, _CACHED_REQUESTS ):
+			return None
+		cache = self._statement_caches.get ( x.thread )
+		if cache is None:
+			cache = self._statement_caches[x.thread] = collections.OrderedDict()
+		hit = cache.pop ( x.query, None ) is not None
+		cache[x.query] = True
+		if len ( cache ) > self._cached_statements:
+			cache.popitem ( last=False )
+		return hit
+	
+	def record ( self, x, wait, elapsed, result ):
+		if isinstance ( result, Exception ):
+			error, rows = result, 0
+		elif isinstance ( result, Sqlite3WorkerResult ):
+			error, rows = None, len ( result[0] )
+		elif isinstance ( result, list ) and not isinstance ( x, Sqlite3WorkerCall ):
+			error, rows = None, len ( result )
+		else:
+			error, rows = None, 0
+		busy = error is not None and _is_busy ( error )
+		sql = self._statement_key ( x )
+		with self._lock:
+			cached = self._statement_cached ( x )
+			if cached:
+				self._cache_hits += 1
+			elif cached is not None:
+				self._cache_misses += 1
+			self._requests += 1
+			self._rows += rows
+			self._wait_total += wait
+			self._wait_max = max ( self._wait_max, wait )
+			self._exec_total += elapsed
+			self._exec_max = max ( self._exec_max, elapsed )
+			if error is not None:
+				self._errors += 1
+				if busy:
+					self._busy += 1
+			stmt = self._statements.get ( sql )
+			if stmt is None:
+				if len ( self._statements ) >= self._max_statements:
+					stmt = None # stop tracking new statements rather than grow without bound
+				else:
+					stmt = self._statements[sql] = { 'count': 0, 'errors': 0, 'rows': 0,
+						'exec_total': 0.0, 'exec_max': 0.0, 'wait_total': 0.0,
+						'cache_hits': 0, 'cache_misses': 0 }
+			if stmt is not None:
+				stmt['count'] += 1
+				stmt['rows'] += rows
+				stmt['exec_total'] += elapsed
+				stmt['exec_max'] = max ( stmt['exec_max'], elapsed )
+				stmt['wait_total'] += wait
+				if error is not None:
+					stmt['errors'] += 1
+				if cached:
+					stmt['cache_hits'] += 1
+				elif cached is not None:
+					stmt['cache_misses'] += 1
+		for hook in self._hooks:
+			hook ( 'request', { 'sql': sql, 'wait': wait, 'elapsed': elapsed, 'rows': rows, 'error': error } )
+	
+	def record_commit ( self, elapsed, error=None ):
+		with self._lock:
+			self._commits += 1
+			self._commit_total += elapsed
+			self._commit_max = max ( self._commit_max, elapsed )
+			if error is not None and _is_busy ( error ):
+				self._busy += 1
+		for hook in self._hooks:
+			hook ( 'commit', { 'elapsed': elapsed, 'error': error } )
+	
+	def snapshot ( self ):
+		with self._lock:
+			uptime = time.time() - self._started
+			return {
+				'uptime': uptime,
+				'requests': self._requests,
+				'errors': self._errors,
+				'busy_errors': self._busy,
+				'rows': self._rows,
+				'queue_wait_total': self._wait_total,
+				'queue_wait_max': self._wait_max,
+				'exec_total': self._exec_total,
+				'exec_max': self._exec_max,
+				'commits': self._commits,
+				'commit_total': self._commit_total,
+				'commit_max': self._commit_max,
+				'commits_per_sec': self._commits / uptime if uptime else 0.0,
+				'cached_statements': self._cached_statements,
+				'statement_cache_hits': self._cache_hits,
+				'statement_cache_misses': self._cache_misses,
+				'statements': dict ( ( sql, dict ( stmt ) ) for sql, stmt in self._statements.items() ),
+			}
+
+def _redact ( values ):
+	if isinstance ( values, dict ):
+		return dict ( ( k, '<{}>'.format ( type ( v ).__name__ ) ) for k, v in values.items() )
+	return ['<{}>'.format ( type ( v ).__name__ ) for v in values or ()]
+
+class Sqlite3WorkerProfiler ( object ):
+	"""Slow query log and sampling profiler.
+	Any statement taking slow_query_ms or longer is kept (and logged to the
+	sqlite3worker.slow logger) together with its EXPLAIN QUERY PLAN if
+	explain is set. One in every sample_every requests is kept as a sample.
+	Entries carry the normalized sql, parameter types instead of values, and
+	a breakdown of the time spent queued, executing and fetching.
+	"""
+	def __init__ ( self, slow_query_ms=None, explain=False, sample_every=0, history=100 ):
+		self.slow_query_ms = slow_query_ms
+		self.explain = explain
+		self.sample_every = sample_every
+		self.slow_queries = collections.deque ( maxlen=history )
+		self.samples = collections.deque ( maxlen=history )
+		self._counter = itertools.count ( 1 ) # next() is atomic, readers share this
+	
+	def record ( self, thread, x, queued_at, start, fetch_started, end, result ):
+		total = end - start
+		slow = self.slow_query_ms is not None and total * 1000.0 >= self.slow_query_ms
+		sampled = self.sample_every and next ( self._counter ) % self.sample_every == 0
+		if not ( slow or sampled ):
+			return
+		query = getattr ( x, 'query', None )
+		values = getattr ( x, 'values', None )
+		entry = {
+			'sql': normalize_sql ( query ) if query is not None else '<{}>'.format ( type ( x ).__name__ ),
+			'params': _redact ( values ),
+			'thread': thread.name,
+			'queued_at': queued_at,
+			'wait': start - queued_at,
+			'execute': ( fetch_started or end ) - start,
+			'fetch': end - fetch_started if fetch_started else 0.0,
+			'total': total,
+			'rows': len ( result[0] ) if isinstance ( result, Sqlite3WorkerResult ) else 0,
+			'error': repr ( result ) if isinstance ( result, Exception ) else None,
+		}
+		if slow:
+			if self.explain and query is not None and values is not None:
+				try:
+					entry['plan'] = [tuple ( row ) for row in thread._sqlite3_conn.execute ( 'EXPLAIN QUERY PLAN ' + query, values )]
+				except Exception as err:
+					entry['plan'] = repr ( err )
+			self.slow_queries.append ( entry )
+			SLOW_LOGGER.warning ( 'slow query %.1f ms (queued %.1f ms): %s', total * 1000.0, entry['wait'] * 1000.0, entry['sql'] )
+		if sampled:
+			self.samples.append ( entry )
+
+def _run_instrumented ( thread, x, queued_at, metrics, profiler ):
+	"""Run request x on thread, feeding its timings to metrics and/or profiler (either may be None)."""
+	thread._fetch_started = None
+	start = time.time()
+	result = x.execute()
+	end = time.time()
+	if metrics is not None:
+		metrics.record ( x, start - queued_at, end - start, result )
+	if profiler is not None:
+		profiler.record ( thread, x, queued_at, start, thread._fetch_started, end, result )
+	return result
+
+_PRAGMA_CHOICES = {
+	'journal_mode': ( 'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF' ),
+	'synchronous': ( 'OFF', 'NORMAL', 'FULL', 'EXTRA', '0', '1', '2', '3' ),
+	'temp_store': ( 'DEFAULT', 'FILE', 'MEMORY', '0', '1', '2' ),
+}
+
+def connection_pragmas ( journal_mode=None, synchronous=None, cache_size=None, mmap_size=None, temp_store=None, busy_timeout=None ):
+	"""Check the PRAGMA options Sqlite3Worker accepts and return them as ( name, value ) pairs, skipping the ones left as None.
+	Values are checked here because PRAGMA statements can't take bound parameters.
+	"""
+	pragmas = []
+	for name, value in ( ( 'journal_mode', journal_mode ), ( 'synchronous', synchronous ), ( 'temp_store', temp_store ) ):
+		if value is not None:
+			value = str ( value ).upper()
+			if value not in _PRAGMA_CHOICES[name]:
+				raise ValueError ( '{} must be one of {}, not {!r}'.format ( name, ', '.join ( _PRAGMA_CHOICES[name] ), value ) )
+			pragmas.append ( ( name, value ) )
+	for name, value in ( ( 'cache_size', cache_size ), ( 'mmap_size', mmap_size ), ( 'busy_timeout', busy_timeout ) ):
+		if value is not None:
+			pragmas.append ( ( name, int ( value ) ) )
+	return pragmas
+
+# file: names are opened as URIs ( e.g. shared in-memory databases ), Python 2's sqlite3 can't do that
+_CONNECT_KWARGS = { 'uri': True } if sys.version_info >= ( 3, 4 ) else {}
+
+def _open_connection ( file_name, cached_statements, pragmas, attached=() ):
+	conn = sqlite3.connect (
+		file_name, check_same_thread=False,
+		cached_statements=cached_statements,
+		#detect_types=sqlite3.PARSE_DECLTYPES
+		**_CONNECT_KWARGS
+	)
+	for name, value in pragmas:
+		conn.execute ( 'PRAGMA {}={}'.format ( name, value ) )
+	for alias, attached_file in attached:
+		_attach ( conn, alias, attached_file )
+	return conn
+
+def _quote_identifier ( name ):
+	return '"{}"'.format ( name.replace ( '"', '""' ) )
+
+def _attach ( conn, alias, file_name ):
+	"""ATTACH file_name as alias, or DETACH alias if file_name is None."""
+	if file_name is None:
+		conn.execute ( 'DETACH DATABASE ' + _quote_identifier ( alias ) )
+	else:
+		conn.execute ( 'ATTACH DATABASE ? AS ' + _quote_identifier ( alias ), ( file_name, ) )
+
+def _update_attached ( conn, old, new ):
+	"""Bring conn's attached databases from the ( alias, file_name ) pairs in old to those in new."""
+	for alias, file_name in old:
+		if ( alias, file_name ) not in new:
+			_attach ( conn, alias, None )
+	for alias, file_name in new:
+		if ( alias, file_name ) not in old:
+			_attach ( conn, alias, file_name )
+
+def shared_memory_uri ( name ):
+	"""Return the URI of a named in-memory database.
+	Every Sqlite3Worker opened on it shares one worker thread, and so one
+	database, until the last of them is closed. It can also be attached to
+	another worker, see Sqlite3Worker.attach().
+	"""
+	return 'file:{}?mode=memory&cache=shared'.format ( name.replace ( '%', '%25' ).replace ( '?', '%3f' ).replace ( '#', '%23' ) )
+
+def is_memory_database ( file_name ):
+	"""True for :memory: and in-memory URIs, which only exist inside this process."""
+	if file_name.lower() == ':memory:':
+		return True
+	if not file_name.startswith ( 'file:' ):
+		return False
+	path, _, query = file_name[5:].partition ( '?' )
+	return path in ( '', ':memory:' ) or 'mode=memory' in query.split ( '&' )
+
 def normalize_file_name ( file_name ):
 	if file_name.lower() == ':memory:':
 		return ':memory:'
+	if file_name.startswith ( 'file:' ):
+		return file_name # URIs are passed to sqlite untouched
 	# lookup absolute path of file_name
 	file_name = os.path.abspath ( file_name )
 	if platform.system() == 'Windows':
@@ -160,40 +1033,117 @@ class Sqlite3WorkerThread ( threading.Thread ):
 	_sqlite3_cursor = None
 	_sql_queue = None
 	_max_queue_size = None
+	_group_commit = False
+	_group_commit_statements = None
+	_group_commit_ms = None
+	_uncommitted = 0
+	_uncommitted_since = None
+	_read_queue = None
+	_readers = None
+	_metrics = None
+	_profiler = None
+	_fetch_started = None
+	_tx_owner = None
+	_cached_statements = 128
+	_pragmas = ()
+	_attached = ()
 	
-	def __init__ ( self, file_name, max_queue_size, *args, **kwargs ):
+	def __init__ ( self, file_name, max_queue_size, group_commit=False, group_commit_statements=None, group_commit_ms=None, wal=False, readers=0, metrics=False, profiler=None, cached_statements=128, pragmas=(), attached=(), bulk_every=8, adaptive_queue_ms=None, *args, **kwargs ):
 		super ( Sqlite3WorkerThread, self ).__init__ ( *args, **kwargs )
 		self.daemon = True
 		self._workers = set()
-		self._sqlite3_conn = sqlite3.connect (
-			file_name, check_same_thread=False,
-			#detect_types=sqlite3.PARSE_DECLTYPES
-		)
+		if wal:
+			pragmas = [( 'journal_mode', 'WAL' )] + [p for p in pragmas if p[0] != 'journal_mode']
+		self._cached_statements = cached_statements
+		self._pragmas = pragmas
+		self._attached = tuple ( attached )
+		self._sqlite3_conn = _open_connection ( file_name, cached_statements, pragmas, self._attached )
 		self._sqlite3_cursor = self._sqlite3_conn.cursor()
-		self._sql_queue = Queue.Queue ( maxsize=max_queue_size )
+		target_wait = adaptive_queue_ms / 1000.0 if adaptive_queue_ms is not None else None
+		self._sql_queue = Sqlite3WorkerQueue ( maxsize=max_queue_size, bulk_every=bulk_every, target_wait=target_wait )
 		self._max_queue_size = max_queue_size
+		if metrics:
+			self._metrics = Sqlite3WorkerMetrics ( cached_statements )
+		self._profiler = profiler
+		self._group_commit = group_commit
+		self._group_commit_statements = group_commit_statements
+		self._group_commit_ms = group_commit_ms
 		self.name = self.name.replace ( 'Thread-', 'Sqlite3WorkerThread-' )
+		self._readers = []
+		if readers:
+			self._read_queue = Sqlite3WorkerQueue ( maxsize=max_queue_size, bulk_every=bulk_every, target_wait=target_wait )
+			for i in range ( readers ):
+				self._readers.append ( Sqlite3WorkerReaderThread ( self, file_name, i ) )
 		self.start()
 	
+	def _commit ( self ):
+		metrics = self._metrics
+		if metrics is None:
+			self._sqlite3_conn.commit()
+		else:
+			start = time.time()
+			try:
+				self._sqlite3_conn.commit()
+			except Exception as err:
+				metrics.record_commit ( time.time() - start, err )
+				raise
+			metrics.record_commit ( time.time() - start )
+		self._uncommitted = 0
+		self._uncommitted_since = None
+	
+	def _enable_metrics ( self ):
+		if self._metrics is None:
+			self._metrics = Sqlite3WorkerMetrics ( self._cached_statements )
+		return self._metrics
+	
+	def _group_commit_due ( self ):
+		if self._sql_queue.empty():
+			return True
+		if self._group_commit_statements is not None and self._uncommitted >= self._group_commit_statements:
+			return True
+		if self._group_commit_ms is not None and ( time.time() - self._uncommitted_since ) * 1000.0 >= self._group_commit_ms:
+			return True
+		return False
+	
 	def run ( self ):
 		"""Thread loop.
 		This is an infinite loop.  The iter method calls self._sql_queue.get()
 		which blocks if there are not values in the queue.  As soon as values
 		are placed into the queue the process will continue.
-		If many executes happen at once it will churn through them all before
-		calling commit() to speed things up by reducing the number of times
-		commit is called.
+		If group commit is enabled and many executes happen at once it will
+		churn through them all inside one transaction before calling commit()
+		to speed things up by reducing the number of times commit is called.
+		The group is committed as soon as the queue runs dry, or once
+		group_commit_statements requests or group_commit_ms milliseconds have
+		gone by, whichever comes first.
 		"""
 		LOGGER.debug("run: Thread started")
 		while True:
 			try:
-				x = self._sql_queue.get()
-				x.execute()
+				queued_at, x = self._sql_queue.get_timed()
+				if self._metrics is None and self._profiler is None:
+					x.execute()
+				else:
+					_run_instrumented ( self, x, queued_at, self._metrics, self._profiler )
+				if self._group_commit and not isinstance ( x, Sqlite3WorkerCommit ):
+					if self._uncommitted_since is None:
+						self._uncommitted_since = time.time()
+					self._uncommitted += 1
+					if self._group_commit_due():
+						LOGGER.debug ( 'group commit of %i requests', self._uncommitted )
+						try:
+							self._commit()
+						except Exception as e:
+							LOGGER.error ( 'group commit failed: {!r}'.format ( e ) )
 			except Sqlite3WorkerExit as e:
 				if not self._sql_queue.empty(): # pragma: no cover ( TODO FIXME: come back to this )
 					LOGGER.debug ( 'requeueing the exit event because there are unfinished actions' )
-					self._sql_queue.put ( e ) # push the exit event to the end of the queue
+					self._sql_queue.put ( e, priority=PRIORITY_BULK ) # push the exit event to the end of the queue
 					continue
+				for reader in self._readers:
+					self._read_queue.put ( e, priority=PRIORITY_BULK )
+				for reader in self._readers:
+					reader.join()
 				LOGGER.debug ( 'closing database connection' )
 				self._sqlite3_cursor.close()
 				self._sqlite3_conn.commit()
@@ -201,6 +1151,61 @@ class Sqlite3WorkerThread ( threading.Thread ):
 				LOGGER.debug ( 'exiting thread' )
 				break
 
+class Sqlite3WorkerReaderThread ( threading.Thread ):
+	"""One of a pool of read-only threads serving Sqlite3Worker.query().
+	All readers of a file pull from the writer's shared _read_queue, each
+	request is re-pointed at whichever reader picks it up so it runs against
+	that reader's own connection.
+	"""
+	_writer = None
+	_sqlite3_conn = None
+	_sqlite3_cursor = None
+	_sql_queue = None
+	_profiler = None
+	_fetch_started = None
+	_attached = ()
+	
+	def __init__ ( self, writer, file_name, index ):
+		super ( Sqlite3WorkerReaderThread, self ).__init__()
+		self.daemon = True
+		self._writer = writer
+		# journal_mode belongs to the database file, the writer has already set it
+		pragmas = [p for p in writer._pragmas if p[0] != 'journal_mode']
+		self._attached = writer._attached
+		self._sqlite3_conn = _open_connection ( file_name, writer._cached_statements, pragmas, self._attached )
+		self._sqlite3_conn.execute ( 'PRAGMA query_only=1' )
+		self._sqlite3_cursor = self._sqlite3_conn.cursor()
+		self._sql_queue = writer._read_queue
+		self._profiler = writer._profiler
+		self.name = '{}-reader-{}'.format ( writer.name, index )
+		self.start()
+	
+	def run ( self ):
+		LOGGER.debug ( "run: Reader thread started" )
+		writer = self._writer
+		while True:
+			queued_at, x = self._sql_queue.get_timed()
+			if isinstance ( x, Sqlite3WorkerExit ):
+				break
+			# follow any row/text factory changes made on the writer
+			self._sqlite3_cursor.row_factory = writer._sqlite3_cursor.row_factory
+			self._sqlite3_conn.text_factory = writer._sqlite3_conn.text_factory
+			if self._attached is not writer._attached:
+				attached = writer._attached
+				try:
+					_update_attached ( self._sqlite3_conn, self._attached, attached )
+				except Exception as err:
+					LOGGER.error ( '{} failed to follow the writer\'s attached databases: {!r}'.format ( self.name, err ) )
+				self._attached = attached
+			x.thread = self
+			if writer._metrics is None and self._profiler is None:
+				x.execute()
+			else:
+				_run_instrumented ( self, x, queued_at, writer._metrics, self._profiler )
+		LOGGER.debug ( 'closing reader database connection' )
+		self._sqlite3_cursor.close()
+		self._sqlite3_conn.close()
+
 class Sqlite3Worker ( Frozen_object ):
 	"""Sqlite thread safe object.
 	Example:
@@ -218,26 +1223,94 @@ class Sqlite3Worker ( Frozen_object ):
 	_file_name = None
 	_exit_set = False
 	_thread = None
+	_priority = PRIORITY_INTERACTIVE
+	_backpressure = BACKPRESSURE_TIMEOUT
+	_put_timeout = 5
 	
 	# class shared attributes
 	_threads = {}
 	_threads_lock = threading.Lock()
 	
-	def __init__ ( self, file_name, max_queue_size=100 ):
+	def __init__ ( self, file_name, max_queue_size=100, group_commit=False, group_commit_statements=None, group_commit_ms=None, wal=False, readers=0, metrics=False, slow_query_ms=None, explain_slow_queries=False, sample_every=0,
+			cached_statements=128, journal_mode=None, synchronous=None, cache_size=None, mmap_size=None, temp_store=None, busy_timeout=None, attach=None,
+			priority=PRIORITY_INTERACTIVE, bulk_every=8, backpressure=BACKPRESSURE_TIMEOUT, put_timeout=5, adaptive_queue_ms=None ):
 		"""Automatically starts the thread.
 		Args:
 			file_name: The name of the file.
 			max_queue_size: The max queries that will be queued.
+			group_commit: Commit automatically whenever the worker thread runs out of queued requests.
+			group_commit_statements: With group_commit, also commit after this many requests.
+			group_commit_ms: With group_commit, also commit once the open transaction is this many milliseconds old.
+			wal: Put the database in WAL journal mode so readers don't block the writer.
+			readers: Number of read-only threads (each with its own connection) serving query().
+			metrics: Collect the timings and counters returned by stats().
+			slow_query_ms: Keep statements taking at least this long, see slow_queries().
+			explain_slow_queries: Also keep the EXPLAIN QUERY PLAN of slow statements.
+			sample_every: Keep a full timing breakdown of one in this many requests, see query_samples().
+			cached_statements: Size of each connection's prepared statement cache, stats() reports its hits and misses.
+			journal_mode: PRAGMA journal_mode, e.g. 'WAL' (same as wal=True) or 'TRUNCATE'.
+			synchronous: PRAGMA synchronous, 'OFF', 'NORMAL', 'FULL' or 'EXTRA'.
+			cache_size: PRAGMA cache_size, pages if positive, KiB if negative.
+			mmap_size: PRAGMA mmap_size in bytes.
+			temp_store: PRAGMA temp_store, 'DEFAULT', 'FILE' or 'MEMORY'.
+			busy_timeout: PRAGMA busy_timeout in milliseconds.
+			attach: dict of { alias: file_name } to ATTACH to every connection, see attach().
+			priority: Queue lane for this worker's requests, PRIORITY_INTERACTIVE or PRIORITY_BULK.
+				The execute, query and async methods also take priority to override it for one request.
+			bulk_every: Serve one bulk request after this many interactive ones while both lanes are busy.
+			backpressure: What a request does when its queue lane is full:
+				BACKPRESSURE_TIMEOUT waits up to put_timeout seconds then raises Queue.Full,
+				BACKPRESSURE_BLOCK waits as long as it takes,
+				BACKPRESSURE_FAIL raises Queue.Full straight away,
+				BACKPRESSURE_SHED raises Queue.Full straight away for bulk requests once the
+				queue holds max_queue_size requests in all, interactive ones wait as with timeout.
+			put_timeout: Seconds to wait for room in the queue, see backpressure.
+			adaptive_queue_ms: Shrink and regrow the queue (up to max_queue_size) with the measured
+				throughput, so a full queue holds about this many milliseconds of work.
+		The thread is shared by every Sqlite3Worker opened on the same file, so
+		the queue, group commit and connection settings of the first one opened win.
+		file_name may be a file: URI, shared_memory_uri ( name ) gives a named
+		in-memory database whose thread is shared the same way. A plain :memory:
+		database is private, it always gets a thread of its own.
 		"""
 		
+		if priority not in _PRIORITIES:
+			raise ValueError ( 'priority must be one of {}, not {!r}'.format ( ', '.join ( _PRIORITIES ), priority ) )
+		self._priority = priority
+		if backpressure not in _BACKPRESSURES:
+			raise ValueError ( 'backpressure must be one of {}, not {!r}'.format ( ', '.join ( _BACKPRESSURES ), backpressure ) )
+		self._backpressure = backpressure
+		self._put_timeout = put_timeout
+		if wal and journal_mode is not None and str ( journal_mode ).upper() != 'WAL':
+			raise ValueError ( 'wal=True conflicts with journal_mode={!r}'.format ( journal_mode ) )
+		pragmas = connection_pragmas ( journal_mode, synchronous, cache_size, mmap_size, temp_store, busy_timeout )
 		self._file_name = normalize_file_name ( file_name )
+		if readers and is_memory_database ( self._file_name ):
+			raise ValueError ( 'readers need a database file, an in-memory database is private to its connection' )
+		attached = [( alias, attached_file if is_memory_database ( attached_file ) else normalize_file_name ( attached_file ) )
+			for alias, attached_file in sorted ( ( attach or {} ).items() )]
+		shared = self._file_name != ':memory:'
 		with self._threads_lock:
-			self._thread = self._threads.get ( self._file_name )
+			self._thread = self._threads.get ( self._file_name ) if shared else None
 			if self._thread is None:
-				self._thread = Sqlite3WorkerThread ( self._file_name, max_queue_size )
-				self._threads[self._file_name] = self._thread
-			if self._file_name != ':memory:':
-				self._threads[self._file_name] = self._thread
+				self._thread = Sqlite3WorkerThread (
+					self._file_name, max_queue_size,
+					group_commit=group_commit,
+					group_commit_statements=group_commit_statements,
+					group_commit_ms=group_commit_ms,
+					wal=wal,
+					readers=readers,
+					metrics=metrics,
+					profiler=Sqlite3WorkerProfiler ( slow_query_ms, explain_slow_queries, sample_every )
+						if slow_query_ms is not None or sample_every else None,
+					cached_statements=cached_statements,
+					pragmas=pragmas,
+					attached=attached,
+					bulk_every=bulk_every,
+					adaptive_queue_ms=adaptive_queue_ms,
+				)
+				if shared:
+					self._threads[self._file_name] = self._thread
 			self._thread._workers.add ( self )
 	
 	def close ( self ):
@@ -248,26 +1321,101 @@ class Sqlite3Worker ( Frozen_object ):
 		with self._threads_lock:
 			self._thread._workers.remove ( self )
 			if not self._thread._workers:
-				self._thread._sql_queue.put ( Sqlite3WorkerExit(), timeout=5 )
+				# queued behind the bulk lane, so everything already queued runs first
+				self._thread._sql_queue.put ( Sqlite3WorkerExit(), priority=PRIORITY_BULK )
 				# wait for the thread to finish what it's doing and shut down
 				self._thread.join()
-				try:
-					del self._threads[self._file_name]
-				except KeyError:
-					assert self._file_name == ':memory:'
+				if self._file_name != ':memory:':
+					removed = self._threads.pop ( self._file_name, None )
+					assert removed is self._thread, 'worker thread missing from Sqlite3Worker._threads'
+	
+	def _put ( self, r, queue=None, priority=None ):
+		"""Queue request r for the worker thread (or on queue, e.g. the reader queue).
+		priority picks the queue lane, None for this worker's own priority.
+		"""
+		if threading.current_thread() in ( self._thread, self._thread._tx_owner ):
+			# the worker can't serve this request while it is running a callback or held by this thread's transaction
+			raise ProgrammingError ( 'sqlite worker request would deadlock, use the transaction or connection you were given' )
+		if priority is None:
+			priority = self._priority
+		elif priority not in _PRIORITIES:
+			raise ValueError ( 'priority must be one of {}, not {!r}'.format ( ', '.join ( _PRIORITIES ), priority ) )
+		if queue is None:
+			queue = self._thread._sql_queue
+		backpressure = self._backpressure
+		if backpressure == BACKPRESSURE_TIMEOUT:
+			queue.put ( r, timeout=self._put_timeout, priority=priority )
+		elif backpressure == BACKPRESSURE_BLOCK:
+			queue.put ( r, priority=priority )
+		elif backpressure == BACKPRESSURE_FAIL or ( priority == PRIORITY_BULK and 0 < queue.maxsize <= queue.qsize() ):
+			queue.put ( r, block=False, priority=priority )
+		else: # shedding, but this one gets through
+			queue.put ( r, timeout=self._put_timeout, priority=priority )
 	
 	@property
 	def queue_size ( self ):
 		"""Return the queue size."""
 		return self._thread._sql_queue.qsize()
 	
+	def add_queue_callback ( self, callback, high, low=None ):
+		"""Call callback ( 'high', depth ) once the worker queue is high requests deep, and
+		callback ( 'low', depth ) when it has drained back to low (default high // 2).
+		For load shedding and alerting further up, e.g. have a web front end
+		answer 503 between the two. Callbacks run on whichever thread queued or
+		took the request that crossed the mark, keep them quick and don't call
+		back into the worker from them.
+		"""
+		self._thread._sql_queue.add_watermark ( callback, high, high // 2 if low is None else low )
+	
+	def remove_queue_callback ( self, callback ):
+		self._thread._sql_queue.remove_watermark ( callback )
+	
+	def stats ( self ):
+		"""Return a snapshot of the worker thread's metrics, or None if metrics are off.
+		Timings are in seconds. statements maps each normalized statement to its
+		own count, errors, rows, exec_total, exec_max, wait_total, cache_hits and
+		cache_misses. Lots of statement cache misses mean cached_statements is too
+		small for the number of distinct statements, or values are being pasted
+		into the sql instead of bound.
+		"""
+		metrics = self._thread._metrics
+		if metrics is None:
+			return None
+		snapshot = metrics.snapshot()
+		snapshot['queue_size'] = self._thread._sql_queue.qsize()
+		snapshot['queue_high_water'] = self._thread._sql_queue.high_water
+		snapshot['queue_max_size'] = self._thread._sql_queue.maxsize
+		return snapshot
+	
+	def reset_stats ( self ):
+		if self._thread._metrics is not None:
+			self._thread._metrics.reset()
+	
+	def slow_queries ( self ):
+		"""Return the most recent slow statements, oldest first, [] if the slow query log is off."""
+		profiler = self._thread._profiler
+		return list ( profiler.slow_queries ) if profiler is not None else []
+	
+	def query_samples ( self ):
+		"""Return the most recent sampled requests, oldest first, [] if sampling is off."""
+		profiler = self._thread._profiler
+		return list ( profiler.samples ) if profiler is not None else []
+	
+	def add_trace_hook ( self, hook ):
+		"""Call hook ( event, info ) on the worker thread after every request and commit, turns metrics on if needed."""
+		with self._threads_lock:
+			self._thread._enable_metrics().add_hook ( hook )
+	
+	def remove_trace_hook ( self, hook ):
+		self._thread._metrics.remove_hook ( hook )
+	
 	def set_row_factory ( self, row_factory ):
-		self._thread._sql_queue.put ( Sqlite3WorkerSetRowFactory ( self._thread, row_factory ), timeout=5 )
+		self._put ( Sqlite3WorkerSetRowFactory ( self._thread, row_factory ) )
 	
 	def set_text_factory ( self, text_factory ):
-		self._thread._sql_queue.put ( Sqlite3WorkerSetTextFactory ( self._thread, text_factory ), timeout=5 )
+		self._put ( Sqlite3WorkerSetTextFactory ( self._thread, text_factory ) )
 	
-	def execute_ex ( self, query, values=None ):
+	def execute_ex ( self, query, values=None, priority=None ):
 		"""Execute a query.
 		Args:
 			query: The sql string using ? for placeholders of dynamic values.
@@ -283,38 +1431,238 @@ class Sqlite3Worker ( Frozen_object ):
 			raise ProgrammingError ( 'sqlite worker already closed' )
 		LOGGER.debug ( "request execute: %s", query )
 		r = Sqlite3WorkerExecute ( self._thread, query, values or [] )
-		self._thread._sql_queue.put ( r, timeout=5 )
+		self._put ( r, priority=priority )
 		success, result = r.results.get()
 		if not success:
 			raise result
 		else:
 			return result
 	
-	def execute ( self, query, values=None ):
-		return self.execute_ex ( query, values )[0]
+	def execute ( self, query, values=None, priority=None ):
+		return self.execute_ex ( query, values, priority )[0]
 	
-	def executescript_ex ( self, query ):
+	def query_ex ( self, query, values=None, priority=None ):
+		"""Execute a read-only query on the reader pool.
+		Falls back to the writer thread if this worker has no readers. Readers
+		use their own connections so they only see committed data.
+		Returns:
+			a tuple of ( rows, description, lastrowid ), see execute_ex()
+		"""
+		if self._exit_set:
+			LOGGER.debug ( "Exit set, not running: %s", query )
+			raise ProgrammingError ( 'sqlite worker already closed' )
+		LOGGER.debug ( "request query: %s", query )
+		r = Sqlite3WorkerExecute ( self._thread, query, values or [] )
+		self._put ( r, self._read_queue(), priority )
+		success, result = r.results.get()
+		if not success:
+			raise result
+		else:
+			return result
+	
+	def query ( self, query, values=None, priority=None ):
+		return self.query_ex ( query, values, priority )[0]
+	
+	def _read_queue ( self ):
+		if self._thread._read_queue is not None:
+			return self._thread._read_queue
+		return self._thread._sql_queue
+	
+	def executemany_ex ( self, query, seq_of_values, priority=None ):
+		"""Execute a query against every parameter set in seq_of_values.
+		The whole batch is shipped to the worker thread as a single request and
+		runs inside a single transaction, so bulk loads pay for one queue round
+		trip instead of one per row.
+		Args:
+			query: The sql string using ? for placeholders of dynamic values.
+			seq_of_values: An iterable of value tuples, may be a generator.
+		Returns:
+			a tuple of ( rows, description, lastrowid ), see execute_ex()
+		"""
+		if self._exit_set:
+			LOGGER.debug ( "Exit set, not running: %s", query )
+			raise ProgrammingError ( 'sqlite worker already closed' )
+		LOGGER.debug ( "request executemany: %s", query )
+		r = Sqlite3WorkerExecuteMany ( self._thread, query, seq_of_values )
+		self._put ( r, priority=priority )
+		success, result = r.results.get()
+		if not success:
+			raise result
+		else:
+			return result
+	
+	def executemany ( self, query, seq_of_values, priority=None ):
+		return self.executemany_ex ( query, seq_of_values, priority )[0]
+	
+	def executescript_ex ( self, query, priority=None ):
 		if self._exit_set:
 			LOGGER.debug ( "Exit set, not running: %s", query )
 			raise ProgrammingError ( 'sqlite worker already closed' )
 		LOGGER.debug ( "request executescript: %s", query )
 		r = Sqlite3WorkerExecuteScript ( self._thread, query )
-		self._thread._sql_queue.put ( r, timeout=5 )
+		self._put ( r, priority=priority )
 		success, result = r.results.get()
 		if not success:
 			raise result
 		else:
 			return result
 	
-	def executescript ( self, sql ):
-		return self.executescript_ex ( sql )[0]
+	def executescript ( self, sql, priority=None ):
+		return self.executescript_ex ( sql, priority )[0]
+	
+	def _submit ( self, r, priority=None ):
+		"""Queue a request whose reply goes to r.future and return that future without waiting."""
+		self._put ( r, priority=priority )
+		return r.future
+	
+	def _new_future ( self, query ):
+		if self._exit_set:
+			LOGGER.debug ( "Exit set, not running: %s", query )
+			raise ProgrammingError ( 'sqlite worker already closed' )
+		if Future is None: # pragma: no cover ( Python 2 without the futures backport )
+			raise NotImplementedError ( 'asynchronous requests need concurrent.futures (pip install futures)' )
+		return Future()
+	
+	def execute_async ( self, query, values=None, priority=None ):
+		"""Queue a query and return immediately.
+		Returns:
+			a concurrent.futures.Future which resolves to the same
+			( rows, description, lastrowid ) tuple that execute_ex() returns,
+			or raises the exception the query raised.
+		"""
+		future = self._new_future ( query )
+		LOGGER.debug ( "request execute_async: %s", query )
+		return self._submit ( Sqlite3WorkerExecute ( self._thread, query, values or [], future ), priority )
+	
+	def query_async ( self, query, values=None, priority=None ):
+		"""Queue a read-only query on the reader pool and return a Future, see query_ex() and execute_async()."""
+		future = self._new_future ( query )
+		LOGGER.debug ( "request query_async: %s", query )
+		r = Sqlite3WorkerExecute ( self._thread, query, values or [], future )
+		self._put ( r, self._read_queue(), priority )
+		return future
+	
+	def execute_stream ( self, query, values=None, chunk_size=1000 ):
+		"""Execute a query and return a Sqlite3WorkerResultStream to pull its rows in chunks."""
+		if self._exit_set:
+			LOGGER.debug ( "Exit set, not running: %s", query )
+			raise ProgrammingError ( 'sqlite worker already closed' )
+		LOGGER.debug ( "request execute_stream: %s", query )
+		return Sqlite3WorkerResultStream ( self._thread, query, values or [], chunk_size )
+	
+	def iterate ( self, query, values=None, chunk_size=1000 ):
+		"""Generator yielding the rows of a query without loading them all at once.
+		The query is sent when iteration starts. Rows travel from the worker
+		thread chunk_size at a time, breaking out of the loop early releases
+		the worker side cursor.
+		"""
+		stream = self.execute_stream ( query, values, chunk_size )
+		try:
+			for row in stream:
+				yield row
+		finally:
+			stream.close()
+	
+	def executemany_async ( self, query, seq_of_values, priority=None ):
+		"""Queue an executemany() and return a Future, see execute_async()."""
+		future = self._new_future ( query )
+		LOGGER.debug ( "request executemany_async: %s", query )
+		return self._submit ( Sqlite3WorkerExecuteMany ( self._thread, query, seq_of_values, future ), priority )
+	
+	def executescript_async ( self, query, priority=None ):
+		"""Queue an executescript() and return a Future, see execute_async()."""
+		future = self._new_future ( query )
+		LOGGER.debug ( "request executescript_async: %s", query )
+		return self._submit ( Sqlite3WorkerExecuteScript ( self._thread, query, future ), priority )
 	
 	def commit ( self ):
 		if self._exit_set:
 			LOGGER.debug ( "Exit set, not commiting" )
 			raise ProgrammingError ( 'sqlite worker already closed' )
 		LOGGER.debug ( "request commit" )
-		self._thread._sql_queue.put ( Sqlite3WorkerCommit ( self._thread ), timeout=5 )
+		self._put ( Sqlite3WorkerCommit ( self._thread ) )
+	
+	def transaction ( self ):
+		"""Context manager holding the worker thread for a multi-statement transaction.
+		Example:
+			with worker.transaction() as tx:
+				balance = tx.execute ( "SELECT balance from accounts where id = ?", ( 1, ) )[0][0]
+				tx.execute ( "UPDATE accounts set balance = ? where id = ?", ( balance - 10, 1 ) )
+		Statements go through tx, nothing from other threads runs until the block
+		ends. The block commits when it exits normally, on an exception only its
+		own statements are rolled back. Keep the block short, every other user of
+		this database waits for it.
+		"""
+		return Sqlite3WorkerTransactionContext ( self )
+	
+	def run_in_transaction ( self, fn, *args, **kwargs ):
+		"""Run fn ( connection, *args, **kwargs ) on the worker thread inside a transaction and return its result.
+		fn gets the worker's sqlite3.Connection. The transaction commits if fn
+		returns and rolls back its own work if fn raises, the exception is
+		re-raised here.
+		"""
+		if self._exit_set:
+			raise ProgrammingError ( 'sqlite worker already closed' )
+		return self._run ( Sqlite3WorkerRunInTransaction ( self._thread, fn, args, kwargs ) )
+	
+	def call ( self, fn, *args, **kwargs ):
+		"""Run fn ( connection, *args, **kwargs ) on the worker thread and return its result.
+		fn gets the worker's sqlite3.Connection and runs between two queued
+		requests, so a loop of many small statements crosses the thread boundary
+		once instead of once per statement. Exceptions raised by fn are re-raised
+		here. Nothing is committed for you, fn or a later commit() does that.
+		Example:
+			def lookup ( conn, keys ):
+				return [conn.execute ( "SELECT uuid from tester where date = ?", ( k, ) ).fetchone() for k in keys]
+			found = worker.call ( lookup, dates )
+		"""
+		if self._exit_set:
+			LOGGER.debug ( "Exit set, not calling: %r", fn )
+			raise ProgrammingError ( 'sqlite worker already closed' )
+		return self._run ( Sqlite3WorkerCall ( self._thread, fn, args, kwargs ) )
+	
+	def call_async ( self, fn, *args, **kwargs ):
+		"""Queue a call() and return a Future resolving to fn's result, see execute_async()."""
+		future = self._new_future ( fn )
+		LOGGER.debug ( "request call_async: %r", fn )
+		return self._submit ( Sqlite3WorkerCall ( self._thread, fn, args, kwargs, future ) )
+	
+	def attach ( self, file_name, alias ):
+		"""ATTACH another database to the worker's connections as alias.
+		Its tables are then reachable as alias.table from every statement, so
+		cross-database joins and copies run inside sqlite on one connection.
+		Anything uncommitted is committed first, sqlite can't attach inside a
+		transaction. The attachment belongs to the shared thread, every
+		Sqlite3Worker on this database sees it, readers follow it too. Readers
+		have their own connections, so they only see an attached in-memory
+		database if it is a shared_memory_uri(). Shared in-memory databases lock
+		whole tables, commit on their own worker before reading them here.
+		"""
+		if self._exit_set:
+			raise ProgrammingError ( 'sqlite worker already closed' )
+		if not is_memory_database ( file_name ):
+			file_name = normalize_file_name ( file_name )
+		self._run ( Sqlite3WorkerAttach ( self._thread, alias, file_name ) )
+	
+	def detach ( self, alias ):
+		"""DETACH a database added by attach()."""
+		if self._exit_set:
+			raise ProgrammingError ( 'sqlite worker already closed' )
+		self._run ( Sqlite3WorkerAttach ( self._thread, alias, None ) )
+	
+	def _run ( self, r ):
+		"""Queue request r and wait for its reply, raising the exception it failed with."""
+		self._put ( r )
+		success, result = r.results.get()
+		if not success:
+			raise result
+		return result
+	
+	def commit_async ( self ):
+		"""Queue a commit and return a Future that resolves to None once it has run."""
+		future = self._new_future ( 'commit' )
+		LOGGER.debug ( "request commit_async" )
+		return self._submit ( Sqlite3WorkerCommit ( self._thread, future ) )
 	
 	@property
 	def total_changes ( self ):
@@ -323,39 +1671,227 @@ class Sqlite3Worker ( Frozen_object ):
 			raise ProgrammingError ( 'sqlite worker already closed' )
 		return self._thread._sqlite3_conn.total_changes
 
+class Sqlite3WorkerTransactionContext ( Frozen_object ):
+	"""Returned by Sqlite3Worker.transaction(), see there."""
+	worker = None
+	_request = None
+	
+	def __init__ ( self, worker ):
+		self.worker = worker
+	
+	def __enter__ ( self ):
+		if self._request is not None:
+			raise ProgrammingError ( 'transaction already started' )
+		worker = self.worker
+		if worker._exit_set:
+			raise ProgrammingError ( 'sqlite worker already closed' )
+		r = Sqlite3WorkerTransaction ( worker._thread )
+		worker._put ( r )
+		success, result = r.results.get()
+		if not success:
+			raise result
+		self._request = r
+		worker._thread._tx_owner = threading.current_thread()
+		return self
+	
+	def __exit__ ( self, exc_type, exc_value, traceback ):
+		self.worker._thread._tx_owner = None
+		end = Sqlite3WorkerTransactionEnd ( self.worker._thread, exc_type is None )
+		self._request.requests.put ( end )
+		self._request = None
+		success, result = end.results.get()
+		if not success and exc_type is None:
+			raise result
+		return False
+	
+	def _run ( self, r ):
+		if self._request is None:
+			raise ProgrammingError ( 'transaction is not active' )
+		self._request.requests.put ( r )
+		success, result = r.results.get()
+		if not success:
+			raise result
+		return result
+	
+	def execute_ex ( self, query, values=None ):
+		return self._run ( Sqlite3WorkerExecute ( self.worker._thread, query, values or [] ) )
+	
+	def execute ( self, query, values=None ):
+		return self.execute_ex ( query, values )[0]
+	
+	def executemany_ex ( self, query, seq_of_values ):
+		return self._run ( Sqlite3WorkerExecuteMany ( self.worker._thread, query, seq_of_values ) )
+	
+	def executemany ( self, query, seq_of_values ):
+		return self.executemany_ex ( query, seq_of_values )[0]
+
+class Sqlite3WorkerResultStream ( Frozen_object ):
+	"""Caller side handle on a query whose rows come back in chunks.
+	The query runs on a private cursor on the worker thread. Only one chunk
+	is fetched ahead of the one the caller is working on, so memory stays
+	bounded at two chunks however large the result set is. Call close() to
+	drop the rest of the result set early.
+	"""
+	thread = None
+	chunk_size = None
+	description = None
+	lastrowid = None
+	_rows = None
+	_cursor = None
+	_pending = None
+	
+	def __init__ ( self, thread, query, values, chunk_size ):
+		self.thread = thread
+		self.chunk_size = chunk_size
+		r = Sqlite3WorkerStreamOpen ( thread, query, values, chunk_size )
+		thread._sql_queue.put ( r, timeout=5 )
+		success, result = r.results.get()
+		if not success:
+			raise result
+		self._rows, self.description, self.lastrowid, self._cursor = result
+		self._prefetch()
+	
+	def _prefetch ( self ):
+		if self._cursor is not None:
+			self._pending = Sqlite3WorkerStreamFetch ( self.thread, self._cursor, self.chunk_size )
+			self.thread._sql_queue.put ( self._pending, timeout=5 )
+	
+	def fetch_chunk ( self ):
+		"""Return the next chunk of rows, or [] once the result set is exhausted."""
+		rows, self._rows = self._rows, None
+		if rows is not None:
+			return rows
+		if self._pending is None:
+			return []
+		success, result = self._pending.results.get()
+		self._pending = None
+		if not success:
+			self._cursor = None
+			raise result
+		if len ( result ) < self.chunk_size:
+			self._cursor = None # the worker closed it
+		self._prefetch()
+		return result
+	
+	def close ( self ):
+		self._rows = None
+		if self._cursor is not None:
+			# queued behind any outstanding prefetch so the worker closes it after that runs
+			self.thread._sql_queue.put ( Sqlite3WorkerStreamClose ( self.thread, self._cursor ), timeout=5 )
+			self._cursor = None
+			self._pending = None
+	
+	def __iter__ ( self ):
+		try:
+			while True:
+				rows = self.fetch_chunk()
+				if not rows:
+					return
+				for row in rows:
+					yield row
+		finally:
+			self.close()
+
 class Sqlite3worker_dbapi_cursor ( Frozen_object ):
 	con = None
 	rows = None
 	description = None
 	lastrowid = None
+	rowcount = -1
+	arraysize = 1
+	stream = None
+	_pos = 0 # index of the next unread row in rows, rows are never popped
 	
 	def __init__ ( self, con ):
 		self.con = con
 	
 	def close ( self ):
-		pass
+		if self.stream is not None:
+			self.stream.close()
+			self.stream = None
+	
+	def _set ( self, result ):
+		self.rows, self.description, self.lastrowid = result
+		self.rowcount = result.rowcount
+		self._pos = 0
+		return self
 	
 	def execute ( self, sql, values=None ):
-		self.rows, self.description, self.lastrowid = self.con.worker.execute_ex ( sql, values )
+		self.close()
+		if self.con.chunk_size:
+			self.stream = self.con.worker.execute_stream ( sql, values, self.con.chunk_size )
+			self._set ( Sqlite3WorkerResult ( [], self.stream.description, self.stream.lastrowid ) )
+		else:
+			self._set ( self.con.worker.execute_ex ( sql, values ) )
+	
+	def executemany ( self, sql, seq_of_values ):
+		self.close()
+		self._set ( self.con.worker.executemany_ex ( sql, seq_of_values ) )
 	
 	def executescript ( self, sql_script ):
-		self.rows, self.description, self.lastrowid = self.con.worker.executescript_ex ( sql_script )
+		self.close()
+		self._set ( self.con.worker.executescript_ex ( sql_script ) )
+	
+	def _fill ( self ):
+		"""Make sure there are unread rows in self.rows, pulling the next chunk from the stream if need be.
+		Returns False once the result set is exhausted.
+		"""
+		if self.rows is None:
+			return False
+		if self._pos < len ( self.rows ):
+			return True
+		if self.stream is None:
+			return False
+		self.rows, self._pos = self.stream.fetch_chunk(), 0
+		return bool ( self.rows )
+	
+	def _apply_row_factory ( self, rows ):
+		row_factory = self.con.row_factory
+		if row_factory is Sqlite3worker_dbapi_connection.row_factory:
+			return rows
+		return [row_factory ( self, row ) for row in rows]
 	
 	def fetchone ( self ):
-		try:
-			return self.con.row_factory ( self, self.rows.pop ( 0 ) )
-		except IndexError:
+		if not self._fill():
 			return None
+		row = self.rows[self._pos]
+		self._pos += 1
+		return self.con.row_factory ( self, row )
+	
+	def fetchmany ( self, size=None ):
+		if size is None:
+			size = self.arraysize
+		rows = []
+		while len ( rows ) < size and self._fill():
+			end = self._pos + size - len ( rows )
+			rows.extend ( self.rows[self._pos:end] )
+			self._pos = min ( end, len ( self.rows ) )
+		return self._apply_row_factory ( rows )
+	
+	def fetchall ( self ):
+		rows = []
+		while self._fill():
+			rows.extend ( self.rows[self._pos:] if self._pos else self.rows )
+			self._pos = len ( self.rows )
+		return self._apply_row_factory ( rows )
 	
 	def __iter__ ( self ):
-		while self.rows:
-			yield self.fetchone()
+		while self._fill():
+			rows = self.rows
+			row_factory = self.con.row_factory
+			while self._pos < len ( rows ):
+				row = rows[self._pos]
+				self._pos += 1
+				yield row_factory ( self, row )
 
 class Sqlite3worker_dbapi_connection ( Frozen_object ):
 	worker = None
+	chunk_size = None
 	
-	def __init__ ( self, worker ):
+	def __init__ ( self, worker, chunk_size=None ):
+		"""If chunk_size is set cursors stream query results from the worker chunk_size rows at a time."""
 		self.worker = worker
+		self.chunk_size = chunk_size
 	
 	def commit ( self ):
 		self.worker.commit()
@@ -368,6 +1904,11 @@ class Sqlite3worker_dbapi_connection ( Frozen_object ):
 		cur.execute ( sql, values )
 		return cur
 	
+	def executemany ( self, sql, seq_of_values ):
+		cur = self.cursor()
+		cur.executemany ( sql, seq_of_values )
+		return cur
+	
 	def executescript ( self, sql_script ):
 		cur = self.cursor()
 		cur.executescript ( sql_script )
@@ -389,5 +1930,473 @@ class Sqlite3worker_dbapi_connection ( Frozen_object ):
 	def text_factory ( self, text_factory ):
 		self.worker.set_text_factory ( text_factory )
 
-def connect ( file_name ):
-	return Sqlite3worker_dbapi_connection ( Sqlite3Worker ( file_name ) )
+def connect ( file_name, chunk_size=None, **kwargs ):
+	"""dbapi style connection, kwargs (cached_statements, journal_mode, busy_timeout, ...) go to Sqlite3Worker."""
+	return Sqlite3worker_dbapi_connection ( Sqlite3Worker ( file_name, **kwargs ), chunk_size )
+
+# what a Sqlite3WorkerClient may ask the server's Sqlite3Worker to do
+_REMOTE_METHODS = frozenset ( (
+	'execute_ex', 'execute', 'executemany_ex', 'executemany', 'executescript_ex', 'executescript',
+	'query_ex', 'query', 'commit', 'call', 'run_in_transaction', 'set_row_factory', 'set_text_factory',
+	'attach', 'detach', 'stats', 'reset_stats', 'slow_queries', 'query_samples', 'queue_size', 'total_changes',
+) )
+_REMOTE_TRANSACTION_METHODS = frozenset ( ( 'execute_ex', 'execute', 'executemany_ex', 'executemany' ) )
+
+def _default_authkey ( authkey ):
+	# multiprocessing hands the parent's authkey to every child process it starts
+	return multiprocessing.current_process().authkey if authkey is None else authkey
+
+class Sqlite3WorkerServer ( Frozen_object ):
+	"""Shares one Sqlite3Worker with other processes, which talk to it through Sqlite3WorkerClient.
+	The server process owns the only connection that writes to the file, so
+	processes (gunicorn or multiprocessing workers, ...) queue up behind its
+	worker thread instead of fighting over sqlite's file lock and getting
+	"database is locked". Requests and results travel pickled over a
+	multiprocessing.connection, a unix socket by default (a named pipe on
+	Windows, or pass address=( host, port ) for TCP). Clients authenticate with
+	authkey, which defaults to the multiprocessing authkey child processes
+	inherit. Anything that can unpickle can run code, never listen on an
+	address untrusted users can reach.
+	Example:
+		server = Sqlite3WorkerServer ( "/tmp/test.sqlite" ) # in the parent, before starting workers
+		# in each child process:
+		worker = Sqlite3WorkerClient ( server.address )
+		worker.execute ( "INSERT into tester values (?, ?)", ( "2010-01-01 13:00:00", "bow" ) )
+	"""
+	worker = None
+	address = None
+	_authkey = None
+	_listener = None
+	_accept_thread = None
+	_closed = False
+	
+	def __init__ ( self, file_name, address=None, authkey=None, family=None, **kwargs ):
+		"""kwargs are the same as for Sqlite3Worker."""
+		self.worker = Sqlite3Worker ( file_name, **kwargs )
+		self._authkey = _default_authkey ( authkey )
+		self._listener = Listener ( address, family, authkey=self._authkey )
+		self.address = self._listener.address
+		self._accept_thread = threading.Thread ( target=self._accept, name='Sqlite3WorkerServer-accept' )
+		self._accept_thread.daemon = True
+		self._accept_thread.start()
+	
+	def _accept ( self ):
+		while True:
+			try:
+				conn = self._listener.accept()
+			except Exception as err:
+				if self._closed:
+					return
+				LOGGER.warning ( 'Sqlite3WorkerServer rejected a connection: {!r}'.format ( err ) )
+				continue
+			if self._closed:
+				conn.close()
+				return
+			t = threading.Thread ( target=self._serve, args=( conn, ), name='Sqlite3WorkerServer-client' )
+			t.daemon = True
+			t.start()
+	
+	def _serve ( self, conn ):
+		"""Answer one client connection's requests in order until it disconnects."""
+		tx = None
+		try:
+			while True:
+				try:
+					method, args, kwargs = conn.recv()
+				except ( EOFError, IOError, OSError ):
+					return
+				if method == 'iterate':
+					try:
+						self._serve_iterate ( conn, *args )
+					except ( IOError, OSError ): # the client stopped iterating and hung up
+						return
+					continue
+				try:
+					if method == 'transaction':
+						tx = self.worker.transaction()
+						tx.__enter__()
+						result = None
+					elif method == 'transaction_end':
+						tx, ending = None, tx
+						ending.__exit__ ( None if args[0] else ProgrammingError, None, None )
+						result = None
+					elif method in _REMOTE_METHODS:
+						target = tx if tx is not None and method in _REMOTE_TRANSACTION_METHODS else self.worker
+						result = getattr ( target, method )
+						if callable ( result ):
+							result = result ( *args, **kwargs )
+					else:
+						raise ProgrammingError ( 'Sqlite3WorkerServer has no method {!r}'.format ( method ) )
+					reply = ( True, result )
+				except Exception as err:
+					reply = ( False, err )
+				try:
+					self._send ( conn, reply )
+				except ( IOError, OSError ):
+					return
+		finally:
+			if tx is not None: # client went away inside a transaction
+				tx.__exit__ ( ProgrammingError, None, None )
+			conn.close()
+	
+	def _serve_iterate ( self, conn, query, values, chunk_size ):
+		"""Send the rows of a query one chunk per message, ending with an empty chunk."""
+		try:
+			stream = self.worker.execute_stream ( query, values, chunk_size )
+		except Exception as err:
+			self._send ( conn, ( False, err ) )
+			return
+		try:
+			while True:
+				try:
+					rows = stream.fetch_chunk()
+				except Exception as err:
+					self._send ( conn, ( False, err ) )
+					return
+				self._send ( conn, ( True, rows ) )
+				if not rows:
+					return
+		finally:
+			stream.close()
+	
+	@staticmethod
+	def _send ( conn, reply ):
+		try:
+			conn.send ( reply )
+		except ( pickle.PicklingError, TypeError, AttributeError ) as err:
+			# pickling happens before anything is written, the connection is still usable
+			conn.send ( ( False, ProgrammingError ( 'result could not be sent to the client: {!r}'.format ( err ) ) ) )
+	
+	def serve_forever ( self ):
+		"""Block until close() is called from another thread, for a process that only runs the server."""
+		self._accept_thread.join()
+	
+	def close ( self ):
+		"""Stop accepting clients and close the worker once its queue drains."""
+		if self._closed:
+			raise ProgrammingError ( 'sqlite worker server already closed' )
+		self._closed = True
+		try:
+			Client ( self.address, authkey=self._authkey ).close() # wake up accept()
+		except Exception: # pragma: no cover
+			pass
+		self._accept_thread.join()
+		self._listener.close()
+		self.worker.close()
+
+def _remote_call ( conn, method, args, kwargs ):
+	try:
+		conn.send ( ( method, args, kwargs ) )
+	except ( pickle.PicklingError, TypeError, AttributeError ) as err:
+		raise ProgrammingError ( 'request could not be sent to the server: {!r}'.format ( err ) )
+	success, result = conn.recv()
+	if not success:
+		raise result
+	return result
+
+class Sqlite3WorkerClient ( Frozen_object ):
+	"""Sqlite3Worker compatible handle on a Sqlite3WorkerServer running in another process.
+	A client can be shared by the threads of its process, each request is one
+	round trip on the client's connection. Functions passed to call(),
+	run_in_transaction() or set_row_factory() must be picklable, so defined at
+	module level, and importable by the server process.
+	"""
+	address = None
+	_authkey = None
+	_conn = None
+	_lock = None
+	_exit_set = False
+	
+	def __init__ ( self, address, authkey=None ):
+		self.address = address
+		self._authkey = _default_authkey ( authkey )
+		self._conn = Client ( address, authkey=self._authkey )
+		self._lock = threading.Lock()
+	
+	def _connect ( self ):
+		"""Open another connection to the server, for requests that need one to themselves."""
+		if self._exit_set:
+			raise ProgrammingError ( 'sqlite worker already closed' )
+		return Client ( self.address, authkey=self._authkey )
+	
+	def _call ( self, method, *args, **kwargs ):
+		if self._exit_set:
+			raise ProgrammingError ( 'sqlite worker already closed' )
+		with self._lock:
+			return _remote_call ( self._conn, method, args, kwargs )
+	
+	def close ( self ):
+		"""Disconnect, the server and its worker keep running."""
+		if self._exit_set:
+			raise ProgrammingError ( 'sqlite worker already closed' )
+		self._exit_set = True
+		self._conn.close()
+	
+	def execute_ex ( self, query, values=None ):
+		return self._call ( 'execute_ex', query, values )
+	
+	def execute ( self, query, values=None ):
+		return self._call ( 'execute', query, values )
+	
+	def executemany_ex ( self, query, seq_of_values ):
+		return self._call ( 'executemany_ex', query, list ( seq_of_values ) )
+	
+	def executemany ( self, query, seq_of_values ):
+		return self._call ( 'executemany', query, list ( seq_of_values ) )
+	
+	def executescript_ex ( self, query ):
+		return self._call ( 'executescript_ex', query )
+	
+	def executescript ( self, query ):
+		return self._call ( 'executescript', query )
+	
+	def query_ex ( self, query, values=None ):
+		return self._call ( 'query_ex', query, values )
+	
+	def query ( self, query, values=None ):
+		return self._call ( 'query', query, values )
+	
+	def iterate ( self, query, values=None, chunk_size=1000 ):
+		"""Generator yielding the rows of a query, see Sqlite3Worker.iterate().
+		The rows arrive over a connection of their own, so other threads
+		using this client aren't held up while the loop runs.
+		"""
+		conn = self._connect()
+		try:
+			conn.send ( ( 'iterate', ( query, values or [], chunk_size ), {} ) )
+			while True:
+				success, rows = conn.recv()
+				if not success:
+					raise rows
+				if not rows:
+					return
+				for row in rows:
+					yield row
+		finally:
+			conn.close()
+	
+	def commit ( self ):
+		self._call ( 'commit' )
+	
+	def call ( self, fn, *args, **kwargs ):
+		return self._call ( 'call', fn, *args, **kwargs )
+	
+	def run_in_transaction ( self, fn, *args, **kwargs ):
+		return self._call ( 'run_in_transaction', fn, *args, **kwargs )
+	
+	def transaction ( self ):
+		"""Context manager for a multi-statement transaction, see Sqlite3Worker.transaction()."""
+		return Sqlite3WorkerClientTransaction ( self )
+	
+	def set_row_factory ( self, row_factory ):
+		self._call ( 'set_row_factory', row_factory )
+	
+	def set_text_factory ( self, text_factory ):
+		self._call ( 'set_text_factory', text_factory )
+	
+	def attach ( self, file_name, alias ):
+		self._call ( 'attach', file_name, alias )
+	
+	def detach ( self, alias ):
+		self._call ( 'detach', alias )
+	
+	def stats ( self ):
+		return self._call ( 'stats' )
+	
+	def reset_stats ( self ):
+		self._call ( 'reset_stats' )
+	
+	def slow_queries ( self ):
+		return self._call ( 'slow_queries' )
+	
+	def query_samples ( self ):
+		return self._call ( 'query_samples' )
+	
+	@property
+	def queue_size ( self ):
+		return self._call ( 'queue_size' )
+	
+	@property
+	def total_changes ( self ):
+		return self._call ( 'total_changes' )
+
+class Sqlite3WorkerClientTransaction ( Frozen_object ):
+	"""Returned by Sqlite3WorkerClient.transaction().
+	The transaction gets a server connection of its own, for as long as it
+	is open the server's worker thread only runs its statements.
+	"""
+	client = None
+	_conn = None
+	
+	def __init__ ( self, client ):
+		self.client = client
+	
+	def __enter__ ( self ):
+		if self._conn is not None:
+			raise ProgrammingError ( 'transaction already started' )
+		conn = self.client._connect()
+		try:
+			_remote_call ( conn, 'transaction', (), {} )
+		except Exception:
+			conn.close()
+			raise
+		self._conn = conn
+		return self
+	
+	def __exit__ ( self, exc_type, exc_value, traceback ):
+		conn, self._conn = self._conn, None
+		try:
+			_remote_call ( conn, 'transaction_end', ( exc_type is None, ), {} )
+		except Exception:
+			if exc_type is None:
+				raise
+		finally:
+			conn.close()
+		return False
+	
+	def _call ( self, method, *args ):
+		if self._conn is None:
+			raise ProgrammingError ( 'transaction is not active' )
+		return _remote_call ( self._conn, method, args, {} )
+	
+	def execute_ex ( self, query, values=None ):
+		return self._call ( 'execute_ex', query, values )
+	
+	def execute ( self, query, values=None ):
+		return self._call ( 'execute', query, values )
+	
+	def executemany_ex ( self, query, seq_of_values ):
+		return self._call ( 'executemany_ex', query, list ( seq_of_values ) )
+	
+	def executemany ( self, query, seq_of_values ):
+		return self._call ( 'executemany', query, list ( seq_of_values ) )
+
+def _get_loop(): # pragma: no cover ( which branch runs depends on the python version )
+	try:
+		return asyncio.get_running_loop()
+	except AttributeError:
+		return asyncio.get_event_loop()
+
+def _copy_future ( future, afuture, transform ):
+	if afuture.cancelled():
+		return
+	err = future.exception()
+	if err is not None:
+		afuture.set_exception ( err )
+		return
+	try:
+		result = future.result()
+		afuture.set_result ( result if transform is None else transform ( result ) )
+	except Exception as err:
+		afuture.set_exception ( err )
+
+def _wrap_future ( future, transform=None ):
+	"""Bridge a worker thread Future to an asyncio future on the running loop.
+	The worker thread hands the result to the loop with call_soon_threadsafe,
+	so awaiting a request never ties up a thread from the executor pool.
+	"""
+	loop = _get_loop()
+	afuture = loop.create_future()
+	def done ( future ):
+		loop.call_soon_threadsafe ( _copy_future, future, afuture, transform )
+	def cancel ( afuture ):
+		if afuture.cancelled():
+			future.cancel()
+	afuture.add_done_callback ( cancel )
+	future.add_done_callback ( done )
+	return afuture
+
+def _first ( result ):
+	return result[0]
+
+class AsyncSqlite3Worker ( Frozen_object ):
+	"""asyncio front end for Sqlite3Worker.
+	Every method returns an awaitable, requests go to the same worker thread
+	the blocking API uses.
+	Example:
+		worker = AsyncSqlite3Worker ( "/tmp/test.sqlite" )
+		await worker.execute ( "INSERT into tester values (?, ?)", ( "2010-01-01 13:00:00", "bow" ) )
+		rows = await worker.execute ( "SELECT * from tester" )
+		await worker.close()
+	"""
+	worker = None
+	
+	def __init__ ( self, file_name, **kwargs ):
+		"""Args are the same as for Sqlite3Worker."""
+		if asyncio is None: # pragma: no cover ( Python 2 )
+			raise NotImplementedError ( 'AsyncSqlite3Worker needs asyncio' )
+		self.worker = Sqlite3Worker ( file_name, **kwargs )
+	
+	def execute_ex ( self, query, values=None ):
+		return _wrap_future ( self.worker.execute_async ( query, values ) )
+	
+	def execute ( self, query, values=None ):
+		return _wrap_future ( self.worker.execute_async ( query, values ), _first )
+	
+	def executemany_ex ( self, query, seq_of_values ):
+		return _wrap_future ( self.worker.executemany_async ( query, seq_of_values ) )
+	
+	def executemany ( self, query, seq_of_values ):
+		return _wrap_future ( self.worker.executemany_async ( query, seq_of_values ), _first )
+	
+	def executescript_ex ( self, query ):
+		return _wrap_future ( self.worker.executescript_async ( query ) )
+	
+	def executescript ( self, query ):
+		return _wrap_future ( self.worker.executescript_async ( query ), _first )
+	
+	def query_ex ( self, query, values=None ):
+		return _wrap_future ( self.worker.query_async ( query, values ) )
+	
+	def query ( self, query, values=None ):
+		return _wrap_future ( self.worker.query_async ( query, values ), _first )
+	
+	def call ( self, fn, *args, **kwargs ):
+		return _wrap_future ( self.worker.call_async ( fn, *args, **kwargs ) )
+	
+	def commit ( self ):
+		return _wrap_future ( self.worker.commit_async() )
+	
+	def close ( self ):
+		# close() may have to wait for the worker thread to drain its queue and exit,
+		# that one wait is handed to the default executor instead of blocking the loop
+		return _get_loop().run_in_executor ( None, self.worker.close )
+
+class Sqlite3worker_dbapi_async_cursor ( Sqlite3worker_dbapi_cursor ):
+	"""dbapi style cursor whose execute methods are awaitable, fetching stays synchronous."""
+	
+	def execute ( self, sql, values=None ):
+		return _wrap_future ( self.con.worker.execute_async ( sql, values ), self._set )
+	
+	def executemany ( self, sql, seq_of_values ):
+		return _wrap_future ( self.con.worker.executemany_async ( sql, seq_of_values ), self._set )
+	
+	def executescript ( self, sql_script ):
+		return _wrap_future ( self.con.worker.executescript_async ( sql_script ), self._set )
+
+class Sqlite3worker_dbapi_async_connection ( Sqlite3worker_dbapi_connection ):
+	"""dbapi style connection for asyncio, execute(), commit() and close() are awaitable."""
+	
+	def commit ( self ):
+		return _wrap_future ( self.worker.commit_async() )
+	
+	def cursor ( self ):
+		return Sqlite3worker_dbapi_async_cursor ( self )
+	
+	def execute ( self, sql, values=None ):
+		return self.cursor().execute ( sql, values )
+	
+	def executemany ( self, sql, seq_of_values ):
+		return self.cursor().executemany ( sql, seq_of_values )
+	
+	def executescript ( self, sql_script ):
+		return self.cursor().executescript ( sql_script )
+	
+	def close ( self ):
+		worker, self.worker = self.worker, None
+		return _get_loop().run_in_executor ( None, worker.close )
+
+def connect_async ( file_name, **kwargs ):
+	if asyncio is None: # pragma: no cover ( Python 2 )
+		raise NotImplementedError ( 'connect_async needs asyncio' )
+	return Sqlite3worker_dbapi_async_connection ( Sqlite3Worker ( file_name, **kwargs ) )
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2014 Palantir Technologies
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""sqlite3worker benchmarks.
+
+Times the hot paths of sqlite3worker against the same work done with the
+plain sqlite3 module, on a temp file and on :memory:.
+
+	python sqlite3worker_bench.py --json results.json
+	python sqlite3worker_bench.py --compare results.json
+
+Every result is a dict with the benchmark name, backend, implementation
+("sqlite3worker" or "sqlite3"), operation count, elapsed seconds and
+ops_per_sec, so runs from different releases can be diffed by machine.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import sqlite3worker
+
+timer = getattr ( time, 'perf_counter', time.time )
+
+SCHEMA = "CREATE TABLE tester (id INTEGER PRIMARY KEY, timestamp DATETIME, uuid TEXT, value REAL)"
+INSERT = "INSERT into tester (timestamp, uuid, value) values (?, ?, ?)"
+SELECT = "SELECT * from tester"
+
+def make_row ( i ):
+	return ( "2010-01-01 13:00:00", "uuid-{}".format ( i ), i * 0.5 )
+
+class Backend ( object ):
+	"""Hands out a fresh database for every benchmark so runs don't see each other's data."""
+
+	def __init__ ( self, name ):
+		self.name = name
+		self.file_name = None
+
+	def __enter__ ( self ):
+		if self.name == 'memory':
+			self.file_name = ':memory:'
+		else:
+			self.file_name = tempfile.mktemp ( suffix='.sqlite', prefix='sqlite3worker_bench' )
+		return self
+
+	def __exit__ ( self, *exc_info ):
+		if self.file_name != ':memory:':
+			for suffix in ( '', '-wal', '-shm', '-journal' ):
+				if os.path.exists ( self.file_name + suffix ):
+					os.unlink ( self.file_name + suffix )
+
+	def worker ( self, populate=0, **kwargs ):
+		worker = sqlite3worker.Sqlite3Worker ( self.file_name, **kwargs )
+		worker.execute ( SCHEMA )
+		if populate:
+			worker.executemany ( INSERT, ( make_row ( i ) for i in range ( populate ) ) )
+			worker.commit()
+		return worker
+
+	def raw ( self, populate=0 ):
+		con = sqlite3.connect ( self.file_name, check_same_thread=False )
+		con.execute ( SCHEMA )
+		if populate:
+			con.executemany ( INSERT, ( make_row ( i ) for i in range ( populate ) ) )
+			con.commit()
+		return con
+
+def timed ( fn ):
+	start = timer()
+	fn()
+	return timer() - start
+
+def run_threads ( count, target ):
+	threads = [threading.Thread ( target=target, args=( i, ) ) for i in range ( count )]
+	start = timer()
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	return timer() - start
+
+# each benchmark yields ( name, implementation, ops, seconds, extra ) tuples
+
+def bench_execute_single_thread ( backend, n ):
+	with backend:
+		worker = backend.worker()
+		def run():
+			for i in range ( n ):
+				worker.execute ( INSERT, make_row ( i ) )
+		yield 'execute_single_thread', 'sqlite3worker', n, timed ( run ), {}
+		worker.close()
+	with backend:
+		con = backend.raw()
+		def run():
+			for i in range ( n ):
+				con.execute ( INSERT, make_row ( i ) )
+		yield 'execute_single_thread', 'sqlite3', n, timed ( run ), {}
+		con.close()
+
+def bench_execute_threads ( backend, n, threads ):
+	per_thread = max ( 1, n // threads )
+	with backend:
+		worker = backend.worker()
+		def run ( t ):
+			for i in range ( per_thread ):
+				worker.execute ( INSERT, make_row ( i ) )
+		yield 'execute_threads', 'sqlite3worker', per_thread * threads, run_threads ( threads, run ), { 'threads': threads }
+		worker.close()
+	with backend:
+		# the fair comparison for raw sqlite3 is one shared connection behind a lock
+		con = backend.raw()
+		lock = threading.Lock()
+		def run ( t ):
+			for i in range ( per_thread ):
+				with lock:
+					con.execute ( INSERT, make_row ( i ) )
+		yield 'execute_threads', 'sqlite3', per_thread * threads, run_threads ( threads, run ), { 'threads': threads }
+		con.close()
+
+def bench_commits ( backend, n ):
+	with backend:
+		worker = backend.worker()
+		def run():
+			for i in range ( n ):
+				worker.execute ( INSERT, make_row ( i ) )
+				worker.commit()
+			worker.commit_async().result()
+		yield 'commit_every_write', 'sqlite3worker', n, timed ( run ), {}
+		worker.close()
+	with backend:
+		worker = backend.worker ( group_commit=True )
+		def run():
+			for i in range ( n ):
+				worker.execute ( INSERT, make_row ( i ) )
+			worker.commit_async().result()
+		yield 'group_commit', 'sqlite3worker', n, timed ( run ), {}
+		worker.close()
+	with backend:
+		worker = backend.worker()
+		def run():
+			worker.executemany ( INSERT, ( make_row ( i ) for i in range ( n ) ) )
+			worker.commit_async().result()
+		yield 'batched_write', 'sqlite3worker', n, timed ( run ), {}
+		worker.close()
+	with backend:
+		con = backend.raw()
+		def run():
+			for i in range ( n ):
+				con.execute ( INSERT, make_row ( i ) )
+				con.commit()
+		yield 'commit_every_write', 'sqlite3', n, timed ( run ), {}
+		con.close()
+	with backend:
+		con = backend.raw()
+		def run():
+			con.executemany ( INSERT, ( make_row ( i ) for i in range ( n ) ) )
+			con.commit()
+		yield 'batched_write', 'sqlite3', n, timed ( run ), {}
+		con.close()
+
+def bench_large_select ( backend, n ):
+	with backend:
+		worker = backend.worker ( populate=n )
+		yield 'select_fetchall', 'sqlite3worker', n, timed ( lambda: worker.execute ( SELECT ) ), {}
+		def run():
+			for row in worker.iterate ( SELECT ):
+				pass
+		yield 'select_iterate', 'sqlite3worker', n, timed ( run ), {}
+		worker.close()
+	with backend:
+		con = backend.raw ( populate=n )
+		yield 'select_fetchall', 'sqlite3', n, timed ( lambda: con.execute ( SELECT ).fetchall() ), {}
+		con.close()
+
+def bench_row_factories ( backend, n ):
+	with backend:
+		worker = backend.worker ( populate=n )
+		con = sqlite3worker.Sqlite3worker_dbapi_connection ( worker )
+		for name, factory in (
+			( 'tuple', None ),
+			( 'dict_factory', sqlite3worker.dict_factory ),
+			( 'namedtuple_factory', sqlite3worker.namedtuple_factory ),
+			( 'Row', sqlite3worker.Row ),
+		):
+			if factory is not None:
+				con.row_factory = factory
+			yield 'row_factory_' + name, 'sqlite3worker', n, timed ( lambda: con.execute ( SELECT ).fetchall() ), {}
+		worker.close()
+	with backend:
+		con = backend.raw ( populate=n )
+		yield 'row_factory_tuple', 'sqlite3', n, timed ( lambda: con.execute ( SELECT ).fetchall() ), {}
+		con.row_factory = sqlite3.Row
+		yield 'row_factory_Row', 'sqlite3', n, timed ( lambda: con.execute ( SELECT ).fetchall() ), {}
+		con.close()
+
+def bench_dbapi_iteration ( backend, n ):
+	with backend:
+		worker = backend.worker ( populate=n )
+		for chunk_size in ( None, 1000 ):
+			con = sqlite3worker.Sqlite3worker_dbapi_connection ( worker, chunk_size )
+			def run():
+				for row in con.execute ( SELECT ):
+					pass
+			yield 'dbapi_iterate', 'sqlite3worker', n, timed ( run ), { 'chunk_size': chunk_size }
+		worker.close()
+	with backend:
+		con = backend.raw ( populate=n )
+		def run():
+			for row in con.execute ( SELECT ):
+				pass
+		yield 'dbapi_iterate', 'sqlite3', n, timed ( run ), {}
+		con.close()
+
+def bench_queue_saturation ( backend, n, threads, queue_sizes ):
+	per_thread = max ( 1, n // threads )
+	for max_queue_size in queue_sizes:
+		with backend:
+			worker = backend.worker ( max_queue_size=max_queue_size )
+			def run ( t ):
+				futures = [worker.execute_async ( INSERT, make_row ( i ) ) for i in range ( per_thread )]
+				for f in futures:
+					f.result()
+			yield 'queue_saturation', 'sqlite3worker', per_thread * threads, run_threads ( threads, run ), {
+				'threads': threads, 'max_queue_size': max_queue_size }
+			worker.close()
+
+def run_benchmarks ( scale=1.0, backends=( 'memory', 'file' ), threads=4, queue_sizes=( 1, 10, 100, 1000 ) ):
+	"""Run the whole suite and return a list of result dicts."""
+	n = max ( 10, int ( 10000 * scale ) )
+	commit_n = max ( 10, int ( 1000 * scale ) )
+	select_n = max ( 10, int ( 100000 * scale ) )
+	results = []
+	for backend_name in backends:
+		backend = Backend ( backend_name )
+		for bench in (
+			bench_execute_single_thread ( backend, n ),
+			bench_execute_threads ( backend, n, threads ),
+			bench_commits ( backend, commit_n ),
+			bench_large_select ( backend, select_n ),
+			bench_row_factories ( backend, select_n ),
+			bench_dbapi_iteration ( backend, select_n ),
+			bench_queue_saturation ( backend, n, threads, queue_sizes ),
+		):
+			for name, implementation, ops, seconds, extra in bench:
+				result = {
+					'name': name,
+					'backend': backend_name,
+					'implementation': implementation,
+					'ops': ops,
+					'seconds': seconds,
+					'ops_per_sec': ops / seconds if seconds else None,
+				}
+				result.update ( extra )
+				results.append ( result )
+	return results
+
+def result_key ( result ):
+	return tuple ( sorted ( ( k, str ( v ) ) for k, v in result.items () if k not in ( 'ops', 'seconds', 'ops_per_sec' ) ) )
+
+def compare ( baseline, results, threshold ):
+	"""Return the results that got slower than baseline by more than threshold (0.1 = 10%)."""
+	previous = dict ( ( result_key ( r ), r ) for r in baseline )
+	regressions = []
+	for r in results:
+		old = previous.get ( result_key ( r ) )
+		if old and old['ops_per_sec'] and r['ops_per_sec'] and r['ops_per_sec'] < old['ops_per_sec'] * ( 1.0 - threshold ):
+			regressions.append ( ( old, r ) )
+	return regressions
+
+def describe ( result ):
+	extra = ' '.join ( '{}={}'.format ( k, result[k] ) for k in sorted ( result ) if k not in (
+		'name', 'backend', 'implementation', 'ops', 'seconds', 'ops_per_sec' ) )
+	return '{:<30} {:<7} {:<14} {:>12.0f} ops/s {}'.format (
+		result['name'], result['backend'], result['implementation'], result['ops_per_sec'] or 0, extra )
+
+def main ( argv=None ):
+	parser = argparse.ArgumentParser ( description='sqlite3worker benchmarks' )
+	parser.add_argument ( '--scale', type=float, default=1.0, help='multiply the default operation counts' )
+	parser.add_argument ( '--backend', action='append', choices=( 'memory', 'file' ), help='default: both' )
+	parser.add_argument ( '--threads', type=int, default=4 )
+	parser.add_argument ( '--json', metavar='FILE', help='write the results to FILE as json' )
+	parser.add_argument ( '--compare', metavar='FILE', help='json results of an earlier run to compare against' )
+	parser.add_argument ( '--threshold', type=float, default=0.1, help='slowdown reported as a regression (default 0.1 = 10%%)' )
+	args = parser.parse_args ( argv )
+
+	results = run_benchmarks ( args.scale, tuple ( args.backend or ( 'memory', 'file' ) ), args.threads )
+	for result in results:
+		print ( describe ( result ) )
+	if args.json:
+		with open ( args.json, 'w' ) as f:
+			json.dump ( {
+				'python': platform.python_version(),
+				'sqlite': sqlite3.sqlite_version,
+				'platform': platform.platform(),
+				'time': time.time(),
+				'results': results,
+			}, f, indent=1 )
+	if args.compare:
+		with open ( args.compare ) as f:
+			regressions = compare ( json.load ( f )['results'], results, args.threshold )
+		for old, new in regressions:
+			print ( 'REGRESSION {} was {:.0f} ops/s'.format ( describe ( new ), old['ops_per_sec'] ) )
+		if regressions:
+			return 1
+	return 0
+
+if __name__ == "__main__": # pragma: no cover ( only executed when running the benchmarks directly )
+	sys.exit ( main() )
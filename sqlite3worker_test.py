@@ -27,12 +27,18 @@ __email__ = "dashawn@gmail.com"
 __license__ = "MIT"
 
 import logging
+import multiprocessing
 import os
+import sqlite3
 import sys
 import tempfile
 import threading
 import time
 import uuid
+try:
+    import queue as Queue
+except ImportError: # pragma: no cover ( Python 2 )
+    import Queue
 
 import unittest
 
@@ -41,6 +47,19 @@ import sqlite3worker
 if sys.version_info[0] >= 3:
 	unicode = str
 
+def _insert_from_process ( address, name, count ): # pragma: no cover ( runs in a child process )
+    """Child process body for test_server, module level so multiprocessing can start it any way it likes."""
+    worker = sqlite3worker.Sqlite3WorkerClient ( address )
+    for i in range ( count ):
+        worker.execute ( "INSERT into tester values (?, ?)", ( "2010-01-01 13:00:00", "{}-{}".format ( name, i ) ) )
+    worker.close()
+
+def _return_connection ( conn ):
+    return conn
+
+def _count_rows ( conn, table ):
+    return conn.execute ( "SELECT count(*) from " + table ).fetchone()[0]
+
 class Sqlite3WorkerTests(unittest.TestCase):  # pylint:disable=R0904
     """Test out the sqlite3worker library."""
 
@@ -213,6 +232,624 @@ class Sqlite3WorkerTests(unittest.TestCase):  # pylint:disable=R0904
         con.close()
         self.assertEqual ( count, 25 )
     
+    def test_executemany ( self ):
+        """Make sure executemany consumes a generator in a single request."""
+        def rows():
+            for i in range ( 1000 ):
+                yield ( "2010-01-01 13:00:00", str ( i ) )
+        self.sqlite3worker.executemany ( "INSERT into tester values (?, ?)", rows() )
+        self.assertEqual (
+            self.sqlite3worker.execute ( "SELECT count(*) from tester" ), [( 1000, )] )
+        with self.assertRaises ( sqlite3worker.OperationalError ):
+            self.sqlite3worker.executemany ( "INSERT into nosuchtable values (?)", [( 1, )] )
+        
+        con = sqlite3worker.connect ( self.tmp_file )
+        cur = con.executemany ( "INSERT into tester values (?, ?)", [( "2011-02-02 14:14:14", "dog" )] * 3 )
+        self.assertEqual ( cur.fetchone(), None )
+        cur = con.execute ( "SELECT count(*) from tester where uuid = ?", ( "dog", ) )
+        self.assertEqual ( cur.fetchone(), ( 3, ) )
+        con.close()
+    
+    def test_group_commit ( self ):
+        """Make sure group commit makes writes durable without calling commit()."""
+        tmp_file = tempfile.mktemp ( suffix="pytest", prefix="sqlite" )
+        worker = sqlite3worker.Sqlite3Worker (
+            tmp_file, group_commit=True, group_commit_statements=10, group_commit_ms=50 )
+        try:
+            worker.execute ( "CREATE TABLE tester (timestamp DATETIME, uuid TEXT)" )
+            worker.executemany ( "INSERT into tester values (?, ?)",
+                [( "2010-01-01 13:00:00", str ( i ) ) for i in range ( 100 )] )
+            for i in range ( 25 ):
+                worker.execute ( "INSERT into tester values (?, ?)", ( "2011-02-02 14:14:14", str ( i ) ) )
+            # the reply goes out before the worker gets around to the group commit
+            con = sqlite3.connect ( tmp_file )
+            for _ in range ( 50 ):
+                count = con.execute ( "SELECT count(*) from tester" ).fetchall()
+                if count == [( 125, )]:
+                    break
+                time.sleep ( 0.02 ) # pragma: no cover ( timing dependent )
+            self.assertEqual ( count, [( 125, )] )
+            con.close()
+        finally:
+            worker.close()
+            os.unlink ( tmp_file )
+    
+    def test_execute_async ( self ):
+        """Make sure asynchronous requests resolve through their futures."""
+        futures = [
+            self.sqlite3worker.execute_async (
+                "INSERT into tester values (?, ?)", ( "2010-01-01 13:00:00", str ( i ) ) )
+            for i in range ( 50 )
+        ]
+        futures.append ( self.sqlite3worker.executemany_async (
+            "INSERT into tester values (?, ?)", [( "2011-02-02 14:14:14", "dog" )] * 5 ) )
+        for f in futures:
+            rows, description, lastrowid = f.result ( timeout=5 )
+            self.assertEqual ( rows, [] )
+        self.assertEqual ( futures[0].result()[2], 1 )
+        f = self.sqlite3worker.execute_async ( "SELECT count(*) from tester" )
+        self.assertEqual ( f.result ( timeout=5 )[0], [( 55, )] )
+        f = self.sqlite3worker.executescript_async ( "THIS IS INTENTIONALLY BAD SQL" )
+        self.assertIsInstance ( f.exception ( timeout=5 ), sqlite3worker.OperationalError )
+        self.sqlite3worker.close()
+        with self.assertRaises ( sqlite3worker.ProgrammingError ):
+            self.sqlite3worker.execute_async ( "SELECT * from tester" )
+    
+    def test_readers ( self ):
+        """Make sure query() runs on the reader pool and sees committed writes."""
+        tmp_file = tempfile.mktemp ( suffix="pytest", prefix="sqlite" )
+        worker = sqlite3worker.Sqlite3Worker ( tmp_file, wal=True, readers=3 )
+        try:
+            self.assertEqual ( worker.execute ( "PRAGMA journal_mode" ), [( "wal", )] )
+            worker.execute ( "CREATE TABLE tester (timestamp DATETIME, uuid TEXT)" )
+            worker.execute ( "INSERT into tester values (?, ?)", ( "2010-01-01 13:00:00", "bow" ) )
+            worker.commit()
+            worker.execute ( "INSERT into tester values (?, ?)", ( "2011-02-02 14:14:14", "dog" ) )
+            # the second insert isn't committed yet so readers can't see it
+            self.assertEqual ( worker.query ( "SELECT uuid from tester" ), [( "bow", )] )
+            worker.commit()
+            worker.execute ( "SELECT 1" ) # commit() doesn't wait, make sure it has run
+            futures = [worker.query_async ( "SELECT count(*) from tester" ) for _ in range ( 20 )]
+            for f in futures:
+                self.assertEqual ( f.result ( timeout=5 )[0], [( 2, )] )
+            with self.assertRaises ( sqlite3worker.OperationalError ):
+                worker.query ( "DELETE from tester" )
+            worker.set_row_factory ( sqlite3worker.dict_factory )
+            worker.execute ( "SELECT 1" ) # set_row_factory() doesn't wait either
+            self.assertEqual ( worker.query ( "SELECT uuid from tester where uuid = ?", ( "dog", ) ), [{ "uuid": "dog" }] )
+        finally:
+            worker.close()
+            os.unlink ( tmp_file )
+        self.assertEqual ( self.sqlite3worker.query ( "SELECT * from tester" ), [] ) # no readers, runs on the writer
+        with self.assertRaises ( ValueError ):
+            sqlite3worker.Sqlite3Worker ( ":memory:", readers=2 )
+    
+    @unittest.skipIf ( sqlite3worker.asyncio is None, "needs asyncio" )
+    def test_asyncio ( self ):
+        """Make sure the asyncio front end resolves requests on the event loop."""
+        tmp_file = tempfile.mktemp ( suffix="pytest", prefix="sqlite" )
+        results = {}
+        
+        async def main():
+            worker = sqlite3worker.AsyncSqlite3Worker ( tmp_file )
+            await worker.executescript ( "CREATE TABLE tester (timestamp DATETIME, uuid TEXT)" )
+            await worker.executemany ( "INSERT into tester values (?, ?)",
+                [( "2010-01-01 13:00:00", str ( i ) ) for i in range ( 10 )] )
+            await sqlite3worker.asyncio.gather ( *[
+                worker.execute ( "INSERT into tester values (?, ?)", ( "2011-02-02 14:14:14", "dog" ) )
+                for _ in range ( 10 ) ] )
+            await worker.commit()
+            results["count"] = await worker.query ( "SELECT count(*) from tester" )
+            results["ex"] = await worker.execute_ex ( "SELECT uuid from tester where uuid = ?", ( "dog", ) )
+            try:
+                await worker.execute ( "select THIS IS BAD SQL" )
+            except sqlite3worker.OperationalError:
+                results["error"] = True
+            await worker.close()
+            
+            con = sqlite3worker.connect_async ( tmp_file )
+            cur = await con.execute ( "SELECT uuid from tester where uuid = ?", ( "5", ) )
+            results["fetchone"] = cur.fetchone()
+            await con.executemany ( "INSERT into tester values (?, ?)", [( "2012-03-03 15:15:15", "cat" )] )
+            await con.executescript ( "DELETE from tester where uuid = 'dog'" )
+            await con.commit()
+            cur = await con.execute ( "SELECT count(*) from tester" )
+            results["after"] = cur.fetchone()
+            await con.close()
+        
+        try:
+            sqlite3worker.asyncio.run ( main() )
+        finally:
+            os.unlink ( tmp_file )
+        self.assertEqual ( results["count"], [( 20, )] )
+        self.assertEqual ( len ( results["ex"][0] ), 10 )
+        self.assertEqual ( results["ex"][1][0][0], "uuid" )
+        self.assertTrue ( results["error"] )
+        self.assertEqual ( results["fetchone"], ( "5", ) )
+        self.assertEqual ( results["after"], ( 11, ) )
+    
+    def test_iterate ( self ):
+        """Make sure streamed results arrive in order and can be abandoned early."""
+        self.sqlite3worker.executemany ( "INSERT into tester values (?, ?)",
+            [( "2010-01-01 13:00:00", str ( i ) ) for i in range ( 2500 )] )
+        query = "SELECT uuid from tester order by rowid"
+        rows = list ( self.sqlite3worker.iterate ( query, chunk_size=100 ) )
+        self.assertEqual ( rows, [( str ( i ), ) for i in range ( 2500 )] )
+        self.assertEqual ( len ( list ( self.sqlite3worker.iterate ( query, chunk_size=2500 ) ) ), 2500 )
+        self.assertEqual ( list ( self.sqlite3worker.iterate ( "SELECT * from tester where uuid = 'x'" ) ), [] )
+        for i, row in enumerate ( self.sqlite3worker.iterate ( query, chunk_size=10 ) ):
+            if i == 15:
+                break
+        with self.assertRaises ( sqlite3worker.OperationalError ):
+            list ( self.sqlite3worker.iterate ( "select THIS IS BAD SQL" ) )
+        
+        con = sqlite3worker.connect ( self.tmp_file, chunk_size=1000 )
+        cur = con.execute ( query )
+        self.assertEqual ( cur.description[0][0], "uuid" )
+        self.assertEqual ( cur.fetchone(), ( "0", ) )
+        self.assertEqual ( len ( cur.fetchmany ( 1500 ) ), 1500 )
+        self.assertEqual ( len ( list ( cur ) ), 999 )
+        self.assertEqual ( cur.fetchone(), None )
+        cur = con.execute ( query )
+        cur.fetchone()
+        cur.close()
+        con.close()
+        
+        # the abandoned server side cursors must all be closed for this to work
+        self.sqlite3worker.execute ( "DROP TABLE tester" )
+        self.sqlite3worker.execute ( "CREATE TABLE tester (timestamp DATETIME, uuid TEXT)" )
+    
+    def test_dbapi_fetch ( self ):
+        """Make sure the dbapi cursor supports the PEP 249 fetch methods."""
+        con = sqlite3worker.connect ( self.tmp_file )
+        cur = con.executemany ( "INSERT into tester values (?, ?)",
+            [( "2010-01-01 13:00:00", str ( i ) ) for i in range ( 100 )] )
+        self.assertEqual ( cur.rowcount, 100 )
+        cur = con.execute ( "UPDATE tester set timestamp = ? where uuid < ?", ( "2011-02-02 14:14:14", "2" ) )
+        self.assertEqual ( cur.rowcount, 12 )
+        cur = con.execute ( "SELECT uuid from tester order by rowid" )
+        self.assertEqual ( cur.rowcount, -1 )
+        self.assertEqual ( cur.arraysize, 1 )
+        self.assertEqual ( cur.fetchmany(), [( "0", )] )
+        cur.arraysize = 3
+        self.assertEqual ( cur.fetchmany(), [( "1", ), ( "2", ), ( "3", )] )
+        self.assertEqual ( cur.fetchone(), ( "4", ) )
+        self.assertEqual ( len ( cur.fetchmany ( 90 ) ), 90 )
+        self.assertEqual ( cur.fetchall(), [( str ( i ), ) for i in range ( 95, 100 )] )
+        self.assertEqual ( cur.fetchall(), [] )
+        self.assertEqual ( cur.fetchmany ( 10 ), [] )
+        self.assertEqual ( con.cursor().fetchone(), None )
+        
+        con.row_factory = sqlite3worker.dict_factory
+        cur = con.execute ( "SELECT uuid from tester order by rowid" )
+        self.assertEqual ( cur.fetchmany ( 2 ), [{ "uuid": "0" }, { "uuid": "1" }] )
+        self.assertEqual ( len ( cur.fetchall() ), 98 )
+        con.close()
+        
+        con = sqlite3worker.connect ( self.tmp_file, chunk_size=7 )
+        cur = con.execute ( "SELECT uuid from tester order by rowid" )
+        self.assertEqual ( cur.fetchmany ( 10 ), [( str ( i ), ) for i in range ( 10 )] )
+        self.assertEqual ( len ( cur.fetchall() ), 90 )
+        con.close()
+    
+    def test_row_factories ( self ):
+        """Make sure the bundled row factories work with both worker and dbapi cursors."""
+        self.sqlite3worker.executemany ( "INSERT into tester values (?, ?)",
+            [( "2010-01-01 13:00:00", "bow" ), ( "2011-02-02 14:14:14", "dog" )] )
+        con = sqlite3worker.connect ( self.tmp_file )
+        con.row_factory = sqlite3worker.Row
+        rows = con.execute ( "SELECT timestamp, uuid as UUID from tester order by rowid" ).fetchall()
+        self.assertEqual ( rows[0].keys(), ["timestamp", "UUID"] )
+        self.assertEqual ( rows[1]["uuid"], "dog" )
+        self.assertEqual ( rows[1][1], "dog" )
+        self.assertEqual ( rows[1][-1:], ( "dog", ) )
+        self.assertEqual ( tuple ( rows[0] ), ( "2010-01-01 13:00:00", "bow" ) )
+        self.assertEqual ( len ( rows[0] ), 2 )
+        self.assertIs ( rows[0]._columns, rows[1]._columns )
+        self.assertNotEqual ( rows[0], rows[1] )
+        self.assertEqual ( rows[0], con.execute ( "SELECT timestamp, uuid as UUID from tester order by rowid" ).fetchone() )
+        self.assertFalse ( rows[0] == ( "2010-01-01 13:00:00", "bow" ) )
+        self.assertEqual ( len ( set ( rows + rows ) ), 2 )
+        self.assertIn ( "bow", repr ( rows[0] ) )
+        with self.assertRaises ( IndexError ):
+            rows[0]["nosuchcolumn"]
+        
+        con.row_factory = sqlite3worker.namedtuple_factory
+        rows = con.execute ( "SELECT timestamp, uuid, 1 as 'not an identifier' from tester order by rowid" ).fetchall()
+        self.assertEqual ( rows[1].uuid, "dog" )
+        self.assertEqual ( rows[1], ( "2011-02-02 14:14:14", "dog", 1 ) )
+        self.assertIs ( type ( rows[0] ), type ( rows[1] ) )
+        
+        con.row_factory = sqlite3worker.dict_factory
+        self.assertEqual ( con.execute ( "SELECT uuid from tester order by rowid" ).fetchone(), { "uuid": "bow" } )
+        con.close()
+        
+        # the same factories work on the worker thread against the native sqlite3 cursor
+        self.sqlite3worker.set_row_factory ( sqlite3worker.Row )
+        rows = self.sqlite3worker.execute ( "SELECT uuid from tester order by rowid" )
+        self.assertEqual ( [row["UUID"] for row in rows], ["bow", "dog"] )
+        self.sqlite3worker.set_row_factory ( None )
+    
+    def test_benchmarks ( self ):
+        """Smoke test the benchmark suite at a tiny scale."""
+        import sqlite3worker_bench
+        results = sqlite3worker_bench.run_benchmarks ( scale=0.001, backends=( "memory", ), threads=2, queue_sizes=( 1, ) )
+        names = set ( r["name"] for r in results )
+        self.assertIn ( "execute_threads", names )
+        self.assertIn ( "queue_saturation", names )
+        self.assertEqual ( set ( r["implementation"] for r in results ), set ( ( "sqlite3worker", "sqlite3" ) ) )
+        slower = [dict ( r, ops_per_sec=r["ops_per_sec"] / 2 ) for r in results]
+        self.assertEqual ( len ( sqlite3worker_bench.compare ( results, slower, 0.25 ) ), len ( results ) )
+        self.assertEqual ( sqlite3worker_bench.compare ( slower, results, 0.25 ), [] )
+    
+    def test_metrics ( self ):
+        """Make sure the worker thread collects metrics and calls trace hooks."""
+        self.assertEqual ( self.sqlite3worker.stats(), None )
+        events = []
+        def hook ( event, info ):
+            events.append ( ( event, info ) )
+        self.sqlite3worker.add_trace_hook ( hook )
+        for i in range ( 3 ):
+            self.sqlite3worker.execute ( "INSERT into tester values (?, ?)", ( "2010-01-01 13:00:00", str ( i ) ) )
+        self.sqlite3worker.execute ( "SELECT * from   tester where uuid != '1'" )
+        with self.assertRaises ( sqlite3worker.OperationalError ):
+            self.sqlite3worker.execute ( "select THIS IS BAD SQL" )
+        self.sqlite3worker.commit_async().result()
+        stats = self.sqlite3worker.stats()
+        self.assertEqual ( stats["requests"], 6 ) # the commit is a request too
+        self.assertEqual ( stats["errors"], 1 )
+        self.assertEqual ( stats["rows"], 2 )
+        self.assertEqual ( stats["commits"], 1 )
+        self.assertGreaterEqual ( stats["queue_high_water"], 1 )
+        self.assertEqual ( stats["statements"]["INSERT into tester values (?, ?)"]["count"], 3 )
+        self.assertEqual ( stats["statements"]["SELECT * from tester where uuid != ?"]["rows"], 2 )
+        self.assertEqual ( stats["statements"]["<Sqlite3WorkerCommit>"]["count"], 1 )
+        self.assertEqual ( [e[0] for e in events].count ( "commit" ), 1 )
+        self.assertIsInstance ( events[4][1]["error"], sqlite3worker.OperationalError )
+        self.sqlite3worker.remove_trace_hook ( hook )
+        self.sqlite3worker.reset_stats()
+        self.sqlite3worker.execute ( "SELECT 1" )
+        self.assertEqual ( self.sqlite3worker.stats()["requests"], 1 )
+        self.assertEqual ( len ( events ), 7 )
+        self.assertEqual ( sqlite3worker.normalize_sql ( "select  t1.a from t1 where b = 'it''s' and c > 1.5" ),
+            "select t1.a from t1 where b = ? and c > ?" )
+    
+    def test_slow_query_log ( self ):
+        """Make sure slow statements and samples are recorded with redacted parameters."""
+        tmp_file = tempfile.mktemp ( suffix="pytest", prefix="sqlite" )
+        worker = sqlite3worker.Sqlite3Worker ( tmp_file, slow_query_ms=0, explain_slow_queries=True, sample_every=2 )
+        try:
+            worker.execute ( "CREATE TABLE tester (timestamp DATETIME, uuid TEXT)" )
+            worker.execute ( "INSERT into tester values (?, ?)", ( "2010-01-01 13:00:00", "secret" ) )
+            worker.execute ( "SELECT * from tester where uuid = ?", ( "secret", ) )
+            worker.execute ( "SELECT * from tester where uuid = 'literal'" )
+            worker.execute ( "SELECT 1" ) # entries are recorded after the reply, this makes sure the one before is in
+            slow = worker.slow_queries()[:4]
+            self.assertEqual ( slow[1]["params"], ["<str>", "<str>"] )
+            self.assertEqual ( slow[2]["rows"], 1 )
+            self.assertIn ( "SCAN", str ( slow[2]["plan"] ) )
+            self.assertEqual ( slow[3]["sql"], "SELECT * from tester where uuid = ?" )
+            self.assertNotIn ( "secret", repr ( slow ) )
+            self.assertGreaterEqual ( slow[2]["total"], slow[2]["execute"] + slow[2]["fetch"] - 1e-6 )
+            self.assertGreaterEqual ( len ( worker.query_samples() ), 2 )
+        finally:
+            worker.close()
+            os.unlink ( tmp_file )
+        self.assertEqual ( self.sqlite3worker.slow_queries(), [] )
+        self.assertEqual ( self.sqlite3worker.query_samples(), [] )
+    
+    def test_transaction ( self ):
+        """Make sure transactions are atomic, commit on success and roll back on error."""
+        self.sqlite3worker.execute ( "CREATE TABLE counter (n INTEGER)" )
+        self.sqlite3worker.execute ( "INSERT into counter values (0)" )
+        self.sqlite3worker.commit()
+        
+        class threaded ( threading.Thread ):
+            def __init__ ( self, worker ):
+                threading.Thread.__init__ ( self )
+                self.worker = worker
+                self.start()
+            def run ( self ):
+                for _ in range ( 20 ):
+                    with self.worker.transaction() as tx:
+                        n = tx.execute ( "SELECT n from counter" )[0][0]
+                        tx.execute ( "UPDATE counter set n = ?", ( n + 1, ) )
+        threads = [threaded ( self.sqlite3worker ) for _ in range ( 5 )]
+        for t in threads:
+            t.join()
+        self.assertEqual ( self.sqlite3worker.execute ( "SELECT n from counter" ), [( 100, )] )
+        
+        # uncommitted work from outside the transaction survives its rollback
+        self.sqlite3worker.execute ( "INSERT into tester values (?, ?)", ( "2010-01-01 13:00:00", "outside" ) )
+        with self.assertRaises ( ZeroDivisionError ):
+            with self.sqlite3worker.transaction() as tx:
+                tx.executemany ( "INSERT into tester values (?, ?)", [( "2011-02-02 14:14:14", "inside" )] * 3 )
+                self.assertEqual ( len ( tx.execute ( "SELECT * from tester" ) ), 4 )
+                with self.assertRaises ( sqlite3worker.ProgrammingError ):
+                    self.sqlite3worker.execute ( "SELECT * from tester" ) # would deadlock
+                with self.assertRaises ( sqlite3worker.OperationalError ):
+                    tx.execute ( "select THIS IS BAD SQL" )
+                1 / 0
+        self.assertEqual ( self.sqlite3worker.execute ( "SELECT uuid from tester" ), [( "outside", )] )
+        with self.assertRaises ( sqlite3worker.ProgrammingError ):
+            tx.execute ( "SELECT * from tester" )
+        
+        def withdraw ( conn, amount ):
+            n = conn.execute ( "SELECT n from counter" ).fetchone()[0]
+            if n < amount:
+                raise ValueError ( "insufficient funds" )
+            conn.execute ( "UPDATE counter set n = ?", ( n - amount, ) )
+            return n - amount
+        self.assertEqual ( self.sqlite3worker.run_in_transaction ( withdraw, 30 ), 70 )
+        with self.assertRaises ( ValueError ):
+            self.sqlite3worker.run_in_transaction ( withdraw, 500 )
+        def deadlock ( conn ):
+            self.sqlite3worker.execute ( "SELECT 1" )
+        with self.assertRaises ( sqlite3worker.ProgrammingError ):
+            self.sqlite3worker.run_in_transaction ( deadlock )
+        self.assertEqual ( self.sqlite3worker.execute ( "SELECT n from counter" ), [( 70, )] )
+        con = sqlite3.connect ( self.tmp_file )
+        self.assertEqual ( con.execute ( "SELECT n from counter" ).fetchall(), [( 70, )] ) # committed
+        con.close()
+    
+    def test_call ( self ):
+        """Make sure call() runs functions on the worker thread's connection."""
+        def insert_and_count ( conn, uuids, table="tester" ):
+            for uuid in uuids:
+                conn.execute ( "INSERT into {} values (?, ?)".format ( table ), ( "2010-01-01 13:00:00", uuid ) )
+            return conn.execute ( "SELECT count(*) from {}".format ( table ) ).fetchone()[0], threading.current_thread()
+        count, thread = self.sqlite3worker.call ( insert_and_count, ["a", "b", "c"], table="tester" )
+        self.assertEqual ( count, 3 )
+        self.assertIsNot ( thread, threading.current_thread() )
+        self.assertEqual ( self.sqlite3worker.execute ( "SELECT uuid from tester" ), [( "a", ), ( "b", ), ( "c", )] )
+        with self.assertRaises ( sqlite3worker.OperationalError ):
+            self.sqlite3worker.call ( insert_and_count, ["d"], table="missing" )
+        
+        metrics = sqlite3worker.Sqlite3Worker ( self.tmp_file + "-metrics", metrics=True )
+        try:
+            self.assertEqual ( metrics.call ( lambda conn: ( 1, 2 ) ), ( 1, 2 ) )
+            self.assertEqual ( metrics.call_async ( lambda conn, x: [x] * 3, 7 ).result(), [7, 7, 7] )
+            stats = metrics.stats()
+            self.assertEqual ( stats['statements']['<call <lambda>>']['count'], 2 )
+            self.assertEqual ( stats['rows'], 0 )
+        finally:
+            metrics.close()
+            os.remove ( self.tmp_file + "-metrics" )
+        
+        self.sqlite3worker.close()
+        with self.assertRaises ( sqlite3worker.ProgrammingError ):
+            self.sqlite3worker.call ( insert_and_count, [] )
+    
+    def test_connection_options ( self ):
+        """Make sure connection options reach the connections and the statement cache is counted."""
+        file_name = self.tmp_file + "-options"
+        worker = sqlite3worker.Sqlite3Worker ( file_name, readers=1, metrics=True, cached_statements=2,
+            journal_mode="wal", synchronous="normal", cache_size=-4096, temp_store="memory", busy_timeout=1234 )
+        try:
+            pragma = lambda conn, name: conn.execute ( "PRAGMA " + name ).fetchone()[0]
+            self.assertEqual ( worker.call ( pragma, "journal_mode" ), "wal" )
+            self.assertEqual ( worker.call ( pragma, "synchronous" ), 1 )
+            self.assertEqual ( worker.call ( pragma, "cache_size" ), -4096 )
+            self.assertEqual ( worker.call ( pragma, "temp_store" ), 2 )
+            self.assertEqual ( worker.call ( pragma, "busy_timeout" ), 1234 )
+            self.assertEqual ( worker.query ( "PRAGMA busy_timeout" ), [( 1234, )] ) # readers too
+            worker.execute ( "CREATE TABLE t (k INTEGER)" )
+            worker.reset_stats()
+            for _ in range ( 2 ):
+                for k in range ( 3 ): # 3 distinct statements thrash a cache of 2
+                    worker.execute ( "SELECT * from t where k = {}".format ( k ) )
+            for _ in range ( 3 ):
+                worker.execute ( "SELECT * from t where k = ?", ( 1, ) )
+            worker.execute ( "SELECT 1" )
+            stats = worker.stats()
+            self.assertEqual ( stats['cached_statements'], 2 )
+            stmt = stats['statements']["SELECT * from t where k = ?"]
+            self.assertEqual ( ( stmt['cache_hits'], stmt['cache_misses'] ), ( 2, 7 ) )
+            self.assertEqual ( stats['statement_cache_hits'] + stats['statement_cache_misses'], stats['requests'] )
+        finally:
+            worker.close()
+            for suffix in ( "", "-wal", "-shm" ):
+                if os.path.exists ( file_name + suffix ):
+                    os.remove ( file_name + suffix )
+        with self.assertRaises ( ValueError ):
+            sqlite3worker.Sqlite3Worker ( file_name, synchronous="sometimes" )
+        with self.assertRaises ( ValueError ):
+            sqlite3worker.Sqlite3Worker ( file_name, wal=True, journal_mode="delete" )
+        with self.assertRaises ( ValueError ):
+            sqlite3worker.connect ( file_name, mmap_size="lots" )
+        self.assertFalse ( os.path.exists ( file_name ) )
+    
+    def test_memory_and_attach ( self ):
+        """Make sure :memory: workers are private, named in-memory databases are shared and attach works."""
+        private1 = sqlite3worker.Sqlite3Worker ( ":memory:" )
+        private2 = sqlite3worker.Sqlite3Worker ( ":memory:" )
+        self.assertIsNot ( private1._thread, private2._thread )
+        private1.execute ( "CREATE TABLE t (x)" )
+        self.assertEqual ( private2.execute ( "SELECT name from sqlite_master" ), [] )
+        private1.close()
+        private2.close()
+        
+        uri = sqlite3worker.shared_memory_uri ( "staging-{}".format ( uuid.uuid4() ) )
+        self.assertTrue ( sqlite3worker.is_memory_database ( uri ) )
+        with self.assertRaises ( ValueError ):
+            sqlite3worker.Sqlite3Worker ( uri, readers=1 )
+        staging1 = sqlite3worker.Sqlite3Worker ( uri )
+        staging2 = sqlite3worker.Sqlite3Worker ( uri )
+        self.assertIs ( staging1._thread, staging2._thread )
+        staging1.execute ( "CREATE TABLE staged (date TEXT, uuid TEXT)" )
+        staging2.executemany ( "INSERT into staged values (?, ?)", [( "2010-01-01 13:00:00", "a" ), ( "2010-01-01 13:00:00", "b" )] )
+        staging2.commit_async().result() # other connections hit "table is locked" on uncommitted shared cache tables
+        
+        other = self.tmp_file + "-other"
+        readers = sqlite3worker.Sqlite3Worker ( self.tmp_file + "-readers", readers=1, attach={ "other": other } )
+        try:
+            readers.execute ( "CREATE TABLE other.names (uuid TEXT, name TEXT)" )
+            readers.execute ( "INSERT into other.names values (?, ?)", ( "a", "alpha" ) )
+            readers.attach ( uri, "staging" )
+            readers.execute ( "CREATE TABLE copied AS SELECT * from staging.staged" )
+            readers.commit()
+            join = "SELECT n.name from copied c JOIN other.names n ON n.uuid = c.uuid"
+            self.assertEqual ( readers.execute ( join ), [( "alpha", )] )
+            self.assertEqual ( readers.query ( join ), [( "alpha", )] ) # readers follow the attachments
+            self.assertEqual ( readers.query ( "SELECT count(*) from staging.staged" ), [( 2, )] )
+            readers.detach ( "staging" )
+            with self.assertRaises ( sqlite3worker.OperationalError ):
+                readers.query ( "SELECT count(*) from staging.staged" )
+            with self.assertRaises ( sqlite3worker.OperationalError ):
+                readers.detach ( "staging" )
+        finally:
+            readers.close()
+            staging1.close()
+            staging2.close()
+            os.remove ( self.tmp_file + "-readers" )
+            os.remove ( other )
+        staging3 = sqlite3worker.Sqlite3Worker ( uri ) # the last close dropped the database
+        self.assertEqual ( staging3.execute ( "SELECT name from sqlite_master" ), [] )
+        staging3.close()
+    
+    def test_server ( self ):
+        """Make sure other processes can share a worker through Sqlite3WorkerServer."""
+        self.sqlite3worker.close() # the server's worker must own the file
+        server = sqlite3worker.Sqlite3WorkerServer ( self.tmp_file )
+        try:
+            # spawn rather than fork, forking a process that has threads running can deadlock the child
+            context = multiprocessing.get_context ( "spawn" )
+            processes = [context.Process ( target=_insert_from_process, args=( server.address, "p{}".format ( n ), 25 ) )
+                for n in range ( 3 )]
+            for p in processes:
+                p.start()
+            for p in processes:
+                p.join()
+                self.assertEqual ( p.exitcode, 0 )
+            
+            client = sqlite3worker.Sqlite3WorkerClient ( server.address )
+            self.assertEqual ( client.execute ( "SELECT count(*) from tester" ), [( 75, )] )
+            result = client.execute_ex ( "UPDATE tester set timestamp = ? where uuid like ?", ( "2011-02-02 14:14:14", "p1-%" ) )
+            self.assertEqual ( result.rowcount, 25 )
+            self.assertEqual ( client.call ( _count_rows, "tester" ), 75 )
+            with self.assertRaises ( sqlite3worker.OperationalError ):
+                client.execute ( "select THIS IS BAD SQL" )
+            with self.assertRaises ( sqlite3worker.ProgrammingError ):
+                client.call ( lambda conn: conn ) # can't be pickled
+            with self.assertRaises ( sqlite3worker.ProgrammingError ):
+                client.call ( _return_connection ) # the result can't be pickled
+            self.assertEqual ( len ( list ( client.iterate ( "SELECT * from tester", chunk_size=10 ) ) ), 75 )
+            for row in client.iterate ( "SELECT * from tester", chunk_size=10 ):
+                break # abandons the stream
+            
+            with self.assertRaises ( ZeroDivisionError ):
+                with client.transaction() as tx:
+                    tx.execute ( "DELETE from tester" )
+                    self.assertEqual ( tx.execute ( "SELECT count(*) from tester" ), [( 0, )] )
+                    1 / 0
+            with client.transaction() as tx:
+                tx.executemany ( "INSERT into tester values (?, ?)", ( ( "2012-01-01 00:00:00", str ( i ) ) for i in range ( 5 ) ) )
+            self.assertEqual ( client.query ( "SELECT count(*) from tester" ), [( 80, )] )
+            client.set_row_factory ( sqlite3worker.dict_factory )
+            self.assertEqual ( client.execute ( "SELECT count(*) as n from tester" ), [{ "n": 80 }] )
+            self.assertIsNone ( client.stats() )
+            client.close()
+            with self.assertRaises ( sqlite3worker.ProgrammingError ):
+                client.execute ( "SELECT 1" )
+        finally:
+            server.close()
+        con = sqlite3.connect ( self.tmp_file )
+        self.assertEqual ( con.execute ( "SELECT count(*) from tester" ).fetchall(), [( 80, )] )
+        con.close()
+    
+    def test_priority ( self ):
+        """Make sure interactive requests jump ahead of bulk ones without starving them."""
+        bulk = sqlite3worker.Sqlite3Worker ( self.tmp_file, priority=sqlite3worker.PRIORITY_BULK ) # shares the thread
+        started, release = threading.Event(), threading.Event()
+        def block ( conn ):
+            started.set()
+            release.wait()
+        blocked = self.sqlite3worker.call_async ( block )
+        started.wait()
+        insert = "INSERT into tester values (?, ?)"
+        futures = [bulk.execute_async ( insert, ( "2010-01-01 13:00:00", "b{}".format ( i ) ) ) for i in range ( 10 )]
+        futures += [self.sqlite3worker.execute_async ( insert, ( "2010-01-01 13:00:00", "i{}".format ( i ) ) ) for i in range ( 9 )]
+        futures.append ( bulk.execute_async ( insert, ( "2010-01-01 13:00:00", "i9" ), priority="interactive" ) )
+        release.set()
+        blocked.result()
+        for future in futures:
+            future.result()
+        order = [uuid for uuid, in self.sqlite3worker.execute ( "SELECT uuid from tester order by rowid" )]
+        self.assertEqual ( order, ["i0", "i1", "i2", "i3", "i4", "i5", "i6", "i7", "b0", "i8", "i9"] + ["b{}".format ( i ) for i in range ( 1, 10 )] )
+        with self.assertRaises ( ValueError ):
+            bulk.execute ( "SELECT 1", priority="urgent" )
+        with self.assertRaises ( ValueError ):
+            sqlite3worker.Sqlite3Worker ( self.tmp_file, priority="urgent" )
+        bulk.close()
+        
+        q = sqlite3worker.Sqlite3WorkerQueue ( maxsize=1 )
+        q.put ( "b", priority=sqlite3worker.PRIORITY_BULK )
+        q.put ( "i" ) # a full bulk lane doesn't hold up the interactive one
+        with self.assertRaises ( Queue.Full ):
+            q.put ( "b2", priority=sqlite3worker.PRIORITY_BULK, timeout=0.01 )
+        with self.assertRaises ( Queue.Full ):
+            q.put_nowait ( "i2" )
+        self.assertEqual ( ( q.qsize(), q.high_water ), ( 2, 2 ) )
+        self.assertEqual ( [q.get(), q.get()], ["i", "b"] )
+    
+    def test_backpressure ( self ):
+        """Make sure each backpressure policy behaves when the queue is full."""
+        file_name = self.tmp_file + "-backpressure"
+        worker = sqlite3worker.Sqlite3Worker ( file_name, max_queue_size=2, put_timeout=0.05 )
+        events = []
+        worker.add_queue_callback ( lambda event, depth: events.append ( ( event, depth ) ), 2, 0 )
+        started, release = threading.Event(), threading.Event()
+        def block ( conn ):
+            started.set()
+            release.wait()
+        try:
+            blocked = worker.call_async ( block )
+            started.wait()
+            futures = [worker.execute_async ( "SELECT 1" ) for _ in range ( 2 )]
+            self.assertEqual ( events, [( "high", 2 )] )
+            start = time.time()
+            with self.assertRaises ( Queue.Full ):
+                worker.execute ( "SELECT 1" ) # timeout
+            self.assertGreaterEqual ( time.time() - start, 0.05 )
+            fail = sqlite3worker.Sqlite3Worker ( file_name, backpressure="fail", put_timeout=60 )
+            with self.assertRaises ( Queue.Full ):
+                fail.execute ( "SELECT 1" )
+            shed = sqlite3worker.Sqlite3Worker ( file_name, backpressure="shed", put_timeout=60 )
+            with self.assertRaises ( Queue.Full ):
+                shed.execute ( "SELECT 1", priority="bulk" ) # the bulk lane is empty, but the queue is full
+            block_ = sqlite3worker.Sqlite3Worker ( file_name, backpressure="block" )
+            waiter = threading.Thread ( target=block_.execute, args=( "SELECT 1", ) )
+            waiter.start()
+            time.sleep ( 0.1 )
+            self.assertTrue ( waiter.is_alive() )
+            release.set()
+            waiter.join()
+            blocked.result()
+            for future in futures:
+                future.result()
+            self.assertEqual ( shed.execute ( "SELECT 1", priority="bulk" ), [( 1, )] )
+            self.assertEqual ( events[-1], ( "low", 0 ) )
+            for w in ( fail, shed, block_ ):
+                w.close()
+            with self.assertRaises ( ValueError ):
+                sqlite3worker.Sqlite3Worker ( file_name, backpressure="panic" )
+        finally:
+            release.set()
+            worker.close()
+            os.remove ( file_name )
+        
+        q = sqlite3worker.Sqlite3WorkerQueue ( maxsize=100, target_wait=0.001 )
+        for i in range ( 80 ):
+            q.put ( i )
+        for _ in range ( 33 ): # 2ms per request, a millisecond's worth of queue is next to nothing
+            q.get_timed()
+            time.sleep ( 0.002 )
+        self.assertEqual ( q.maxsize, 1 )
+        q.target_wait = 60.0
+        for _ in range ( 33 ):
+            q.get_timed()
+        self.assertEqual ( q.maxsize, 100 ) # never above the configured size
+    
     def test_coverage ( self ):
         """ a bunch of miscellaneous things to get code coverage to 100% """
         class Foo ( sqlite3worker.Frozen_object ):
@@ -220,6 +857,9 @@ class Sqlite3WorkerTests(unittest.TestCase):  # pylint:disable=R0904
         foo = Foo()
         with self.assertRaises ( AttributeError ):
             foo.bar = 'bar'
+        r = sqlite3worker.Sqlite3WorkerExecute ( self.sqlite3worker._thread, "SELECT 1", [] )
+        with self.assertRaises ( AttributeError ):
+            r.bar = 'bar'
         self.sqlite3worker.set_row_factory ( sqlite3worker.Row )
         self.assertEqual ( self.sqlite3worker.total_changes, 0 )
         self.sqlite3worker.set_text_factory ( unicode )